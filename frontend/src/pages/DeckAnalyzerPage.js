@@ -3,6 +3,7 @@
 import React, { useState, useEffect, useRef } from 'react';
 import '../App.css'; // Use the main App.css file
 import { marked } from 'marked';
+import { useAuth } from '../contexts/AuthContext';
 const BACKEND_HTTP_URL = process.env.REACT_APP_BACKEND_URL || 'http://127.0.0.1:8000';
 
 const StatusBadge = ({ status }) => {
@@ -67,6 +68,7 @@ const ChatWidget = ({ messages, onSendMessage, topic, onClose }) => {
 
 function DeckAnalyzerPage() {
   const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8000';
+  const { currentUser } = useAuth();
   const [file, setFile] = useState(null);
   const [analysisResult, setAnalysisResult] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
@@ -162,8 +164,11 @@ function DeckAnalyzerPage() {
     formData.append('pitchDeck', file);
 
     try {
+      // The token scopes the server-side analysis cache to this user.
+      const headers = currentUser ? { 'Authorization': `Bearer ${await currentUser.getIdToken()}` } : {};
       const response = await fetch(`${BACKEND_URL}/api/analyze`, {
         method: 'POST',
+        headers,
         body: formData,
       });
 
@@ -178,7 +183,7 @@ function DeckAnalyzerPage() {
           suggestedStartupName: data.suggestedStartupName,
           suggestedOneLiner: data.suggestedOneLiner,
           suggestedProblem: data.suggestedProblem,
-          deckText: data.deckText, // Pass the full deck text
+          deckId: data.deckId, // Server-side handle for the extracted deck text
         };
         sessionStorage.setItem('deckAnalysisForPractice', JSON.stringify(practiceData));
       }
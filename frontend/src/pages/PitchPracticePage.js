@@ -494,12 +494,12 @@ function PitchPracticePage() {
                 setSavedProfiles(profiles);
                 if (profiles.length > 0) {
                     const mostRecent = profiles[0];
-                    setStartupDetails({ profileId: mostRecent.id, name: mostRecent.name, pitch: mostRecent.pitch, problem: mostRecent.problem, });
+                    setStartupDetails({ profileId: mostRecent.id, name: mostRecent.name, pitch: mostRecent.pitch, problem: mostRecent.problem, deckId: mostRecent.deckId });
                 } else {
                     const storedData = sessionStorage.getItem('deckAnalysisForPractice');
                     if (storedData) {
                         const analysis = JSON.parse(storedData);
-                        setStartupDetails(prev => ({ ...prev, name: analysis.suggestedStartupName, pitch: analysis.suggestedOneLiner, problem: analysis.suggestedProblem }));
+                        setStartupDetails(prev => ({ ...prev, name: analysis.suggestedStartupName, pitch: analysis.suggestedOneLiner, problem: analysis.suggestedProblem, deckId: analysis.deckId }));
                         sessionStorage.removeItem('deckAnalysisForPractice');
                     }
                 }
@@ -571,7 +571,7 @@ function PitchPracticePage() {
     
     const saveOrUpdateProfile = useCallback(async () => {
         if (!currentUser) return startupDetails;
-        const { name, pitch, problem, profileId } = startupDetails;
+        const { name, pitch, problem, profileId, deckId } = startupDetails;
         if (!name || !pitch || !problem) {
             alert("Please fill out all startup details before starting.");
             return null;
@@ -579,13 +579,13 @@ function PitchPracticePage() {
         try {
             const token = await currentUser.getIdToken();
             const headers = { 'Authorization': `Bearer ${token}`, 'Content-Type': 'application/json' };
-            const payload = { name, pitch, problem };
+            const payload = deckId ? { name, pitch, problem, deckId } : { name, pitch, problem };
             const url = profileId ? `http://localhost:8000/api/profiles/${profileId}` : 'http://localhost:8000/api/profiles';
             const method = profileId ? 'PUT' : 'POST';
             const response = await fetch(url, { method, headers, body: JSON.stringify(payload) });
             if (!response.ok) throw new Error(`Failed to save profile. Status: ${response.status}`);
             const savedProfile = await response.json();
-            const newDetails = { profileId: savedProfile.id, name: savedProfile.name, pitch: savedProfile.pitch, problem: savedProfile.problem };
+            const newDetails = { profileId: savedProfile.id, name: savedProfile.name, pitch: savedProfile.pitch, problem: savedProfile.problem, deckId: savedProfile.deckId };
             setStartupDetails(newDetails);
             setSavedProfiles(prev => {
                 const existing = prev.find(p => p.id === savedProfile.id);
@@ -641,7 +641,7 @@ function PitchPracticePage() {
         const profileId = e.target.value;
         const profile = savedProfiles.find(p => p.id === profileId);
         if (profile) {
-            setStartupDetails({ profileId: profile.id, name: profile.name, pitch: profile.pitch, problem: profile.problem });
+            setStartupDetails({ profileId: profile.id, name: profile.name, pitch: profile.pitch, problem: profile.problem, deckId: profile.deckId });
         } else {
             setStartupDetails({ profileId: '', name: '', pitch: '', problem: '' });
         }
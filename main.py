@@ -14,29 +14,49 @@ This single FastAPI server powers the entire Pre-Seed Funding Kit.
 import fastapi
 import uvicorn
 from fastapi import WebSocket, WebSocketDisconnect, File, UploadFile, Request, Depends, HTTPException, status, Header
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import RedirectResponse, FileResponse, Response
 from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.config import Config
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth
-from google.cloud.speech_v2 import SpeechClient
+from google.cloud.speech_v2 import SpeechClient, SpeechAsyncClient
 from google.cloud.speech_v2.types import cloud_speech
 from google.api_core.client_options import ClientOptions
+from google.api_core import exceptions as google_exceptions
+from google.protobuf import duration_pb2
 import asyncio
 import aiofiles
+import copy
+import hashlib
+import hmac
+import tempfile
 import os
+import time
+import uuid
+import queue
+import math
+import multiprocessing
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import json
 import google.generativeai as genai
 import traceback
 import re
-from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+from python_multipart.multipart import MultipartParser, parse_options_header
+from datetime import datetime, timedelta, timezone
 import shutil
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
 from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional
+from collections import deque, OrderedDict
+from cachetools import LRUCache
 import fitz  # PyMuPDF
 
 from dotenv import load_dotenv
@@ -94,6 +114,7 @@ except Exception as e:
 # --- GOOGLE CLOUD AUTHENTICATION & v2 CLIENT ---
 PROJECT_ID = None
 speech_client_v2 = None
+SPEECH_API_ENDPOINT = "us-central1-speech.googleapis.com"
 try:
     SERVICE_ACCOUNT_FILE_GCP = 'semiotic-mender-461407-n2-9d029397fc74.json'
     if os.path.exists(SERVICE_ACCOUNT_FILE_GCP):
@@ -103,7 +124,7 @@ try:
             PROJECT_ID = data.get('project_id')
         if not PROJECT_ID:
             raise ValueError("Project ID not found in GCP key file.")
-        speech_client_v2 = SpeechClient(client_options=ClientOptions(api_endpoint="us-central1-speech.googleapis.com"))
+        speech_client_v2 = SpeechClient(client_options=ClientOptions(api_endpoint=SPEECH_API_ENDPOINT))
         print(f"Google Cloud Speech v2 client initialized for project: {PROJECT_ID}")
     else:
         print(f"ERROR: GCP service account key not found at {SERVICE_ACCOUNT_FILE_GCP}.")
@@ -158,7 +179,8 @@ INVESTOR_PERSONAS={
       **Your Task:**
       - Review the provided pitch deck context and conversation history.
       - Act as Alex Chen. Ask the next logical question based on the flow of the conversation and your persona. Your questions should feel natural and unscripted, aimed at stress-testing the founder's grasp on their business.
-      """
+      """,
+      "focus_keywords": ["go[- ]to[- ]market", "gtm", "unit economics", "cac", "ltv", "churn", "margin", "revenue", "pric", "charg", "burn", "runway", "financ", "projection", "forecast", "operation", "sales", "channel", "acquisition", "payback", "profit", "cost", "budget", "conversion"]
     },
     "Maria Santos": {
       "system_prompt": """You are Maria Santos, an empathetic and insightful investor who believes the founding team is the single most important factor for success. Your primary goal is to understand the people behind the idea.
@@ -176,7 +198,8 @@ INVESTOR_PERSONAS={
       **Your Task:**
       - Review the provided pitch deck context and conversation history.
       - Act as Maria Santos. Ask a thoughtful, open-ended question that helps you understand the founder's journey, motivation, or team dynamics. Your questions should flow naturally from the conversation.
-      """
+      """,
+      "focus_keywords": ["team", "co-?founder", "founder", "hir", "culture", "conflict", "disagree", "motivat", "personal", "story", "background", "resilien", "passion", "leadership", "employee", "my experience", "why i"]
     },
     "Ben Carter": {
       "system_prompt": """You are Ben Carter, a visionary, strategic investor focused on the big picture. Your primary goal is to determine if this idea can become a massive, category-defining company.
@@ -194,17 +217,156 @@ INVESTOR_PERSONAS={
       **Your Task:**
       - Review the provided pitch deck context and conversation history.
       - Act as Ben Carter. Ask an expansive, strategic question that challenges the founder's assumptions about the market, competition, or their long-term vision. Make the conversation feel like a high-level strategic jam session.
-      """
+      """,
+      "focus_keywords": ["market", "tam", "vision", "moat", "compet", "defensib", "scale", "category", "long[- ]term", "network effect", "platform", "billion", "expan", "strateg", "differentiat", "why now"]
     }
 }
 
+# --- CONVERSATION TRANSCRIPT ---
+# Routing prompts see a bounded rolling window plus a running summary of the turns that fell
+# out of it, so they stop growing with session length. Analysis renders the full entries
+# under its own, much larger budget, so the report never scores from the summary.
+TRANSCRIPT_WINDOW_TURNS = int(os.environ.get("TRANSCRIPT_WINDOW_TURNS", "40"))
+TRANSCRIPT_SUMMARY_TOKENS = int(os.environ.get("TRANSCRIPT_SUMMARY_TOKENS", "600"))
+ROUTER_TRANSCRIPT_TOKENS = int(os.environ.get("ROUTER_TRANSCRIPT_TOKENS", "1500"))
+ANALYSIS_TRANSCRIPT_TOKENS = int(os.environ.get("ANALYSIS_TRANSCRIPT_TOKENS", "24000"))
+INVESTOR_CHAT_MAX_EXCHANGES = int(os.environ.get("INVESTOR_CHAT_MAX_EXCHANGES", "12"))
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English; good enough for budgeting.
+    return len(text) // 4 + 1
+
+class ConversationTranscript:
+    def __init__(self, entries: Optional[List[Dict]] = None):
+        self.entries: List[Dict] = []  # Full history, kept for reports and replays.
+        self.window: deque = deque()   # (line, tokens) for the most recent turns.
+        self.summary_lines: deque = deque()
+        self.summary_tokens = 0
+        for entry in entries or []:
+            self.append(entry.get('role', 'System'), entry.get('content', ''))
+
+    def append(self, role: str, content: str):
+        self.entries.append({'role': role, 'content': content})
+        line = f"{role}: {content}"
+        self.window.append((line, estimate_tokens(line)))
+        while len(self.window) > TRANSCRIPT_WINDOW_TURNS:
+            self._summarize(self.window.popleft()[0])
+
+    def _summarize(self, line: str):
+        # Extractive: the first sentence of each evicted turn, oldest dropped once over budget.
+        role, _, content = line.partition(": ")
+        first_sentence = re.split(r"(?<=[.?!])\s", content.strip(), maxsplit=1)[0][:200]
+        summary_line = f"- {role}: {first_sentence}"
+        self.summary_lines.append(summary_line)
+        self.summary_tokens += estimate_tokens(summary_line)
+        while self.summary_tokens > TRANSCRIPT_SUMMARY_TOKENS and len(self.summary_lines) > 1:
+            self.summary_tokens -= estimate_tokens(self.summary_lines.popleft())
+
+    def last_content(self, role: str) -> str:
+        return next((entry['content'] for entry in reversed(self.entries) if entry['role'] == role), "")
+
+    def render(self, token_budget: int) -> str:
+        """Summary of older turns plus as many of the newest turns as fit in the budget."""
+        header = ""
+        if self.summary_lines:
+            header = "[Summary of earlier conversation]\n" + "\n".join(self.summary_lines) + "\n[Recent conversation]\n"
+        remaining = token_budget - estimate_tokens(header)
+        recent = []
+        for line, tokens in reversed(self.window):
+            if tokens > remaining and recent:
+                break
+            recent.append(line)
+            remaining -= tokens
+        if len(recent) < len(self.window) and not header:
+            header = "[Earlier turns omitted]\n"
+        return header + "\n".join(reversed(recent))
+
+    def render_entries(self, token_budget: int) -> str:
+        """
+        The full transcript for analysis. Over budget, the opening turns (the founder's pitch)
+        and the newest turns are kept verbatim and only the middle of the session is elided.
+        """
+        lines = [f"{entry['role']}: {entry['content']}" for entry in self.entries]
+        costs = [estimate_tokens(line) for line in lines]
+        if sum(costs) <= token_budget:
+            return "\n".join(lines)
+        head_end, used = 0, 0
+        while head_end < len(lines) and used + costs[head_end] <= (token_budget if head_end == 0 else token_budget // 3):
+            used += costs[head_end]
+            head_end += 1
+        tail_start = len(lines)
+        while tail_start > head_end and used + costs[tail_start - 1] <= token_budget:
+            used += costs[tail_start - 1]
+            tail_start -= 1
+        omitted = f"[... {tail_start - head_end} turns omitted ...]"
+        return "\n".join(lines[:head_end] + [omitted] + lines[tail_start:])
+
+def trim_chat_history(chat_session, max_exchanges: int = INVESTOR_CHAT_MAX_EXCHANGES):
+    """Keeps the first exchange (it carries the deck context) and the most recent ones."""
+    history = list(chat_session.history)
+    if max_exchanges > 1 and len(history) > 2 * max_exchanges:
+        chat_session.history = history[:2] + history[-2 * (max_exchanges - 1):]
+
+# --- Local Speaker Router ---
+# Most turns either address an investor by name or are clearly about one persona's focus
+# area, so we only pay for the AI moderator when the local router isn't confident.
+LOCAL_ROUTER_MIN_CONFIDENCE = float(os.environ.get("LOCAL_ROUTER_MIN_CONFIDENCE", "0.6"))
+FOCUS_PATTERNS = {
+    name: re.compile(r"\b(?:" + "|".join(persona.get("focus_keywords", [])) + r")\w*", re.IGNORECASE)
+    for name, persona in INVESTOR_PERSONAS.items() if persona.get("focus_keywords")
+}
+VOCATIVE_LEAD_IN = r"(?:(?:hi|hey|hello|thanks|thank you|so|well|ok|okay|right|yes|no|sure|(?:good|great) question|great)[\s,!.]*)?"
+
+def vocative_pattern(name: str) -> re.Pattern:
+    """Matches the investor's name used to address them: "Alex, ...", "Thanks Alex - ...", "..., Maria?"."""
+    first, *rest = name.split()
+    spoken = re.escape(first) + "".join(rf"(?:\s+{re.escape(part)})?" for part in rest)
+    return re.compile(rf"^\s*{VOCATIVE_LEAD_IN}{spoken}\s*(?:[,:!?.\u2014-]|$)|,\s*{spoken}\s*[?.!]*\s*$", re.IGNORECASE)
+
+VOCATIVE_PATTERNS = {name: vocative_pattern(name) for name in INVESTOR_PERSONAS}
+
+def route_speaker_locally(text: str, investor_names: List[str], last_investor_name: Optional[str] = None):
+    """
+    Returns (investor_name, confidence) without calling a model. Direct address wins outright;
+    otherwise investors are scored by how many of their focus keywords the statement hits.
+    A name only counts as address in vocative position: "Like Ben mentioned, ..." is about Ben,
+    not to him.
+    """
+    if not investor_names:
+        return None, 0.0
+    if text.strip() == "[Silent Response]" and last_investor_name in investor_names:
+        return last_investor_name, 1.0  # The investor who asked gets to press the point.
+
+    # Each sentence can open (or close) with a vocative; the earliest one is being spoken to.
+    for sentence in re.split(r"(?<=[.!?])\s+", text.strip()):
+        for name in investor_names:
+            pattern = VOCATIVE_PATTERNS.get(name) or vocative_pattern(name)
+            if pattern.search(sentence):
+                return name, 1.0
+
+    scores = {name: len(FOCUS_PATTERNS[name].findall(text)) for name in investor_names if name in FOCUS_PATTERNS}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    if not ranked or ranked[0][1] == 0:
+        return None, 0.0
+    top_name, top_hits = ranked[0]
+    runner_up_hits = ranked[1][1] if len(ranked) > 1 else 0
+    # Margin over the runner-up, damped for single-keyword hits.
+    confidence = (top_hits - runner_up_hits) / top_hits * min(1.0, top_hits / 2)
+    return top_name, confidence
+
 # --- NEW: AI-powered Speaker Selection ---
-async def choose_next_speaker(conversation_history: List[Dict], investor_names: List[str]) -> Optional[str]:
-    """Uses an AI model to select the most appropriate investor to speak next."""
+async def choose_next_speaker(transcript: ConversationTranscript, investor_names: List[str], last_investor_name: Optional[str] = None) -> Optional[str]:
+    """Selects the investor to speak next, asking the AI moderator only when the local router is unsure."""
+    last_founder_text = transcript.last_content('You')
+    local_choice, confidence = route_speaker_locally(last_founder_text, investor_names, last_investor_name)
+    if local_choice and confidence >= LOCAL_ROUTER_MIN_CONFIDENCE:
+        print(f"Local router chose: {local_choice} (confidence {confidence:.2f})")
+        return local_choice
+
     if not gemini_pro_model:
         return None # Fallback will be triggered
 
-    history_str = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation_history])
+    history_str = transcript.render(ROUTER_TRANSCRIPT_TOKENS)
     investor_list_str = ", ".join(investor_names)
 
     prompt = f"""You are the moderator of a startup pitch meeting.
@@ -238,16 +400,130 @@ Your task is to choose which investor should speak next to create a realistic an
         return None
 
 
+# --- LOCAL MODERATION PRE-FILTER ---
+# Unambiguous abuse is rejected locally. Only placeholders, a short allowlist of acknowledgements
+# and plain numbers are passed without a model call; everything else, including anything
+# touching the "review" lexicon, still goes to Gemini for the abuse and trolling check.
+# Block terms must have no innocent reading ("summa cum laude", "retard growth", ...).
+MODERATION_BLOCK_TERMS = [
+    "fuck you", "fuck off", "go fuck yourself", "motherfucker", "motherfuckers", "cunt", "cunts",
+    "bitch", "bitches", "asshole", "assholes", "dickhead", "dickheads",
+    "shithead", "shitheads", "faggot", "faggots", "nigger", "niggers", "kill yourself", "go die", "blowjob",
+    "jerk off", "whore", "whores", "slut", "sluts", "suck my dick", "suck my cock", "suck my balls",
+    "nice tits", "show me your tits", "i will rape", "ill rape", "i will kill you", "ill kill you",
+    "gonna kill you", "i will shoot you", "i will stab you",
+]
+MODERATION_REVIEW_TERMS = [
+    "fuck", "fucking", "fucked", "shit", "shitty", "bullshit", "damn", "crap", "piss", "idiot", "idiots",
+    "stupid", "moron", "morons", "dumb", "hate", "kill", "die", "sex", "sexy", "naked", "nazi", "hitler",
+    "terrorist", "race", "racist", "jews", "muslims", "christians", "blacks", "whites", "gays", "women",
+    "immigrants", "lol", "lmao", "rofl", "haha", "hahaha", "deez", "nuts", "sus", "yo mama",
+    "retard", "retards", "retarded", "kys", "porn", "porno", "nudes", "cum", "shut up", "clown", "loser",
+    "useless", "pathetic", "trash", "garbage", "sucks", "screw", "dick", "dicks", "cock", "cocks",
+    "tits", "boobs", "pussy", "penis", "vagina", "horny", "suck", "rape", "raped", "rapist", "raping",
+    "murder", "shoot", "stab", "bomb", "hell", "go to hell",
+]
+MODERATION_SAFE_REPLIES = {
+    "yes", "yeah", "yep", "no", "nope", "ok", "okay", "sure", "right", "correct", "exactly",
+    "thanks", "thank you", "thanks a lot", "thank you so much", "got it", "of course", "absolutely",
+    "good question", "great question", "not yet",
+}
+PLAIN_NUMBER_PATTERN = re.compile(r"\$?\d[\d,.]*%?")
+LEET_TRANSLATION = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s"})
+MODERATION_CACHE_SIZE = int(os.environ.get("MODERATION_CACHE_SIZE", "2048"))
+
+class AhoCorasickMatcher:
+    """Multi-pattern matcher: one pass over the text finds every whole-word lexicon hit."""
+    def __init__(self, patterns: Dict[str, str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[tuple]] = [[]]
+        for pattern, label in patterns.items():
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({}); self.fail.append(0); self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append((pattern, label))
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find_all(self, text: str) -> List[tuple]:
+        """Returns (pattern, label) for each match bounded by non-letters on both sides."""
+        matches, node = [], 0
+        for index, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for pattern, label in self.output[node]:
+                start, end = index - len(pattern) + 1, index + 1
+                if (start == 0 or not text[start - 1].isalpha()) and (end == len(text) or not text[end].isalpha()):
+                    matches.append((pattern, label))
+        return matches
+
+moderation_matcher = AhoCorasickMatcher({
+    **{term: "review" for term in MODERATION_REVIEW_TERMS},
+    **{term: "block" for term in MODERATION_BLOCK_TERMS},
+})
+moderation_verdict_cache = LRUCache(maxsize=MODERATION_CACHE_SIZE)
+
+def normalize_for_moderation(text: str) -> str:
+    return re.sub(r"\s+", " ", text.lower().translate(LEET_TRANSLATION)).strip()
+
+def prefilter_moderation(text: str) -> Optional[str]:
+    """Returns 'SAFE' or 'UNSAFE' when the text can be decided locally, else None to escalate."""
+    stripped = text.strip()
+    if re.fullmatch(r"\[[^\]]*\]", stripped):
+        return "SAFE"  # Server/client placeholders such as "[Silent Response]".
+    normalized = normalize_for_moderation(stripped)
+    labels = {label for _, label in moderation_matcher.find_all(normalized)}
+    if "block" in labels:
+        return "UNSAFE"
+    if "review" in labels:
+        return None
+    # Masked words ("f*ck"), shouting, keyboard mashing and links are left to the model.
+    if re.search(r"[a-z][*#!%^&]+[a-z]", normalized) or "http" in normalized or "www." in normalized:
+        return None
+    letters = [c for c in stripped if c.isalpha()]
+    if len(letters) >= 12 and sum(c.isupper() for c in letters) / len(letters) > 0.7:
+        return None
+    if re.search(r"(.)\1{4,}", normalized) or re.search(r"[b-df-hj-np-tv-xz]{6,}", normalized):
+        return None
+    # Matched against the raw text: the leet translation would turn digits into letters.
+    if PLAIN_NUMBER_PATTERN.fullmatch(stripped.rstrip(".!?")):
+        return "SAFE"  # e.g. "$20,000", "40%".
+    if " ".join(re.sub(r"[^\w\s]", "", stripped.lower()).split()) in MODERATION_SAFE_REPLIES:
+        return "SAFE"  # e.g. "Yes.", "Thank you!".
+    return None
+
 # --- KILL SWITCH EVALUATION FUNCTIONS ---
 async def check_for_inappropriate_content(text: str, model: genai.GenerativeModel):
     if not text.strip(): return True, "No content to moderate."
+    cache_key = normalize_for_moderation(text)
+    decision = moderation_verdict_cache.get(cache_key) or prefilter_moderation(text)
+    if decision:
+        moderation_verdict_cache[cache_key] = decision
+        if decision == "UNSAFE":
+            return False, "Inappropriate or abusive language detected."
+        return True, "Content is safe."
     if not model: return True, "Moderation model not available."
     prompt = f"""You are a strict moderator for a professional startup pitch meeting. Analyze the following founder's statement. Your only job is to determine if the statement is abusive, hateful, contains slurs, is sexually explicit, or is a clear attempt to troll. If the statement is acceptable for a professional (even if bad) pitch, respond with ONLY the word "SAFE". If the statement is unacceptable, respond with ONLY the word "UNSAFE". Founder's statement: "{text}". Your response:"""
     try:
         response = await run_in_threadpool(model.generate_content, prompt)
         decision = response.text.strip().upper()
         if decision == "UNSAFE":
+            moderation_verdict_cache[cache_key] = "UNSAFE"
             return False, "Inappropriate or abusive language detected."
+        moderation_verdict_cache[cache_key] = "SAFE"
         return True, "Content is safe."
     except Exception as e:
         return True, "Moderation check errored out."
@@ -266,20 +542,40 @@ async def evaluate_pitch_opening(text: str, model: genai.GenerativeModel):
         return 'PROCEED', "Evaluation check errored out."
 
 # --- PITCH ANALYSIS CLASS ---
+# Only the Default Alive/Dead verdict feeds the other prompts, so everything after it is
+# fanned out concurrently, bounded by a semaphore and a per-call timeout.
+ANALYSIS_MAX_CONCURRENCY = int(os.environ.get("ANALYSIS_MAX_CONCURRENCY", "4"))
+ANALYSIS_CALL_TIMEOUT = float(os.environ.get("ANALYSIS_CALL_TIMEOUT", "45"))
+
+PILLARS_CONFIG = {
+    "Problem/Solution Fit": "Assess if a hair-on-fire problem was articulated and if the solution is obviously better for those users.",
+    "Formidable Founders (Clarity & Conviction)": "Assess how 'formidable' the founders seem based on clarity, directness, and confidence. Critically, if you see a '[System: ... hesitation]' note, it means the founder froze under pressure. This should lead to a very low score for this pillar.",
+    "Market / 'Why Now?'": "Evaluate the articulation of market size, opportunity, and the timeliness ('Why Now?') of the solution."
+}
+
 class PitchAnalyzer:
-    def __init__(self, conversation_history):
+    def __init__(self, conversation_history, transcript: Optional[ConversationTranscript] = None,
+                 max_concurrency: int = ANALYSIS_MAX_CONCURRENCY, call_timeout: float = ANALYSIS_CALL_TIMEOUT):
         self.conversation_history = conversation_history
+        self.transcript = transcript or ConversationTranscript(conversation_history)
         self.analysis_results = {}
         self.analysis_model = analysis_model
+        self.call_timeout = call_timeout
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
     def _format_history_for_analysis(self):
-        # The history now uses 'content' as the key.
-        return "\n".join(f"{entry.get('role', 'System')}: {entry.get('content', '')}" for entry in self.conversation_history)
-    async def _get_analysis_from_gemini(self, prompt, max_retries=2):
+        return self.transcript.render_entries(ANALYSIS_TRANSCRIPT_TOKENS)
+    async def _get_analysis_from_gemini(self, prompt, max_retries=2, generation_config=None):
         if not self.analysis_model: return "Error: Analysis model not available."
         for attempt in range(max_retries):
             try:
-                response = await run_in_threadpool(self.analysis_model.generate_content, prompt)
+                async with self._semaphore:
+                    response = await asyncio.wait_for(
+                        run_in_threadpool(self.analysis_model.generate_content, prompt, generation_config=generation_config, request_options={"timeout": self.call_timeout}),
+                        timeout=self.call_timeout
+                    )
                 return response.text.strip()
+            except asyncio.TimeoutError:
+                if attempt >= max_retries - 1: return f"Error: The analysis model timed out after {self.call_timeout:.0f}s."
             except Exception as e:
                 if attempt >= max_retries - 1: return f"Error: Could not get a response from the analysis model. Details: {e}"
         return "Error: Analysis failed after multiple retries."
@@ -292,19 +588,13 @@ class PitchAnalyzer:
                 if 1 <= score <= scale_max: return score
             except (ValueError, IndexError): pass
         return "N/A"
-    async def analyze_pitch(self):
-        full_conversation_text = self._format_history_for_analysis()
+    def _split_lines(self, text_response):
+        return [line.strip() for line in text_response.splitlines() if line.strip()]
+    async def _assess_default_alive_dead(self, full_conversation_text):
         dad_prompt = f"Based on the following startup pitch conversation, assess if it sounds 'Default Alive' or 'Default Dead'. A '[System: ... hesitation]' note indicates the founder was unprepared for a question or was silent. This is a major negative signal. Factor this heavily into your assessment of their viability.\n\nConversation:\n{full_conversation_text}\n\nAssessment:"
-        dad_assessment = await self._get_analysis_from_gemini(dad_prompt)
-        self.analysis_results["default_alive_dead"] = dad_assessment
-        pillars_config = {
-            "Problem/Solution Fit": "Assess if a hair-on-fire problem was articulated and if the solution is obviously better for those users.",
-            "Formidable Founders (Clarity & Conviction)": "Assess how 'formidable' the founders seem based on clarity, directness, and confidence. Critically, if you see a '[System: ... hesitation]' note, it means the founder froze under pressure. This should lead to a very low score for this pillar.",
-            "Market / 'Why Now?'": "Evaluate the articulation of market size, opportunity, and the timeliness ('Why Now?') of the solution."
-        }
-        self.analysis_results["pillars"] = {}
-        for pillar_name, detail in pillars_config.items():
-            score_prompt = f"""
+        return await self._get_analysis_from_gemini(dad_prompt)
+    async def _analyze_pillar(self, pillar_name, detail, dad_assessment, full_conversation_text):
+        score_prompt = f"""
 **Primary Context**: An initial assessment of the pitch concluded the startup is '{dad_assessment}'.
 **Your Task**: Based on this primary context AND the full conversation below, score the specific pillar '{pillar_name}' from 1 (Poor) to 5 (Excellent).
 - **Pillar Detail**: {detail}
@@ -313,7 +603,7 @@ class PitchAnalyzer:
 **Full Conversation:**
 {full_conversation_text}
 **Score for {pillar_name}:**"""
-            feedback_prompt = f"""
+        feedback_prompt = f"""
 **Primary Context**: An initial assessment of the pitch concluded the startup is '{dad_assessment}'.
 **Your Task**: Based on the primary context and the full conversation, provide specific, bullet-point feedback on '{pillar_name}'.
 - **Instructions**: If the founder hesitated, call it out directly. Your feedback must align with the '{dad_assessment}' conclusion, explaining how this pillar contributed to it. Keep feedback concise.
@@ -321,12 +611,15 @@ class PitchAnalyzer:
 **Full Conversation:**
 {full_conversation_text}
 **Feedback for {pillar_name}:**"""
-            score_response = await self._get_analysis_from_gemini(score_prompt)
-            feedback_response = await self._get_analysis_from_gemini(feedback_prompt)
-            self.analysis_results["pillars"][pillar_name] = {
-                "score": self._parse_numerical_score(score_response),
-                "feedback": [line.strip() for line in feedback_response.splitlines() if line.strip()]
-            }
+        score_response, feedback_response = await asyncio.gather(
+            self._get_analysis_from_gemini(score_prompt),
+            self._get_analysis_from_gemini(feedback_prompt)
+        )
+        return {
+            "score": self._parse_numerical_score(score_response),
+            "feedback": self._split_lines(feedback_response)
+        }
+    async def _brutal_feedback(self, dad_assessment, full_conversation_text):
         brutal_prompt = f"""
 **Primary Context**: An initial assessment of the pitch concluded the startup is '{dad_assessment}'.
 **Your Task**: Based on this primary context and the full conversation, provide specific, brutally honest, and actionable feedback points.
@@ -335,7 +628,8 @@ class PitchAnalyzer:
 **Full Conversation:**
 {full_conversation_text}
 **Brutally Honest Feedback:**"""
-        self.analysis_results["brutal_feedback"] = [line.strip() for line in (await self._get_analysis_from_gemini(brutal_prompt)).splitlines() if line.strip()]
+        return self._split_lines(await self._get_analysis_from_gemini(brutal_prompt))
+    async def _top_3_areas(self, dad_assessment, full_conversation_text):
         top_3_prompt = f"""
 **Primary Context**: An initial assessment of the pitch concluded the startup is '{dad_assessment}'.
 **Your Task**: Based on the primary context and the conversation, identify the top 3 most critical areas to improve.
@@ -343,9 +637,157 @@ class PitchAnalyzer:
 **Full Conversation:**
 {full_conversation_text}
 **Top 3 Areas for Next Practice:**"""
-        self.analysis_results["top_3_areas"] = [line.strip() for line in (await self._get_analysis_from_gemini(top_3_prompt)).splitlines() if line.strip()]
+        return self._split_lines(await self._get_analysis_from_gemini(top_3_prompt))
+    async def _publish_section(self, on_section, section, data, name=None):
+        if on_section:
+            await on_section(section, data, name)
+    async def analyze_pitch(self, on_section=None):
+        """
+        Builds the report. `on_section(section, data, name)` is awaited as each part resolves,
+        with section being 'default_alive_dead', 'pillar' (name set), 'brutal_feedback' or 'top_3_areas'.
+        """
+        full_conversation_text = self._format_history_for_analysis()
+        dad_assessment = await self._assess_default_alive_dead(full_conversation_text)
+        self.analysis_results["default_alive_dead"] = dad_assessment
+        await self._publish_section(on_section, "default_alive_dead", dad_assessment)
+
+        async def run_section(section, name, coro):
+            try:
+                result = await coro
+            except Exception as e:
+                # A failed section is reported in place so the rest of the report still goes out.
+                print(f"Analysis section '{name or section}' failed: {e}")
+                error_line = f"Error: This section could not be generated. Details: {e}"
+                result = {"score": "N/A", "feedback": [error_line]} if section == "pillar" else [error_line]
+            await self._publish_section(on_section, section, result, name)
+            return result
+
+        jobs = [("pillar", name, self._analyze_pillar(name, detail, dad_assessment, full_conversation_text)) for name, detail in PILLARS_CONFIG.items()]
+        jobs.append(("brutal_feedback", None, self._brutal_feedback(dad_assessment, full_conversation_text)))
+        jobs.append(("top_3_areas", None, self._top_3_areas(dad_assessment, full_conversation_text)))
+        results = await asyncio.gather(*(run_section(*job) for job in jobs))
+
+        self.analysis_results["pillars"] = {}
+        for (section, name, _), result in zip(jobs, results):
+            if section == "pillar":
+                self.analysis_results["pillars"][name] = result
+            else:
+                self.analysis_results[section] = result
+        return self.analysis_results
+
+# --- STRUCTURED ANALYSIS ENGINE ---
+# Asks for the whole report in one schema-constrained JSON response instead of nine prompts
+# that each re-send the conversation. Invalid output gets a cheap repair round that does not
+# include the conversation; if that fails too, the multi-call engine produces the report.
+ANALYSIS_ENGINE = os.environ.get("ANALYSIS_ENGINE", "multi_call")  # "multi_call" or "structured"
+ANALYSIS_REPAIR_ATTEMPTS = int(os.environ.get("ANALYSIS_REPAIR_ATTEMPTS", "1"))
+
+class PillarAssessment(BaseModel):
+    name: str
+    score: int = Field(..., ge=1, le=5)
+    feedback: List[str]
+
+class StructuredPitchReport(BaseModel):
+    default_alive_dead: str = Field(..., min_length=1)
+    pillars: List[PillarAssessment]
+    brutal_feedback: List[str] = Field(..., min_length=1)
+    top_3_areas: List[str] = Field(..., min_length=1, max_length=3)
+
+STRUCTURED_REPORT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "default_alive_dead": {"type": "STRING"},
+        "pillars": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING", "enum": list(PILLARS_CONFIG.keys())},
+                    "score": {"type": "INTEGER"},
+                    "feedback": {"type": "ARRAY", "items": {"type": "STRING"}},
+                },
+                "required": ["name", "score", "feedback"],
+            },
+        },
+        "brutal_feedback": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "top_3_areas": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["default_alive_dead", "pillars", "brutal_feedback", "top_3_areas"],
+}
+
+class StructuredPitchAnalyzer(PitchAnalyzer):
+    generation_config = {"response_mime_type": "application/json", "response_schema": STRUCTURED_REPORT_SCHEMA}
+
+    def _build_structured_prompt(self, full_conversation_text):
+        pillar_lines = "\n".join(f"- '{name}': {detail}" for name, detail in PILLARS_CONFIG.items())
+        return f"""You are evaluating a startup pitch conversation. Produce the full report as a single JSON object.
+
+**Step 1 - default_alive_dead**: Assess if the pitch sounds 'Default Alive' or 'Default Dead', with a short justification. A '[System: ... hesitation]' note indicates the founder was unprepared for a question or was silent. This is a major negative signal. Factor this heavily into your assessment of their viability.
+
+**Step 2 - pillars**: For EACH pillar below, give a score from 1 (Poor) to 5 (Excellent) and concise bullet-point feedback. Scores and feedback MUST be consistent with your Step 1 verdict (a 'Default Dead' verdict means scores should be low, likely 1-2). A hesitation note, especially for 'Formidable Founders', must result in a very low score. If the founder hesitated, call it out directly.
+{pillar_lines}
+
+**Step 3 - brutal_feedback**: Specific, brutally honest, actionable feedback points explaining *why* the pitch got its verdict. No fluff.
+
+**Step 4 - top_3_areas**: The top 3 most critical areas to improve in the next practice, addressing the root causes of the verdict.
+
+**Full Conversation:**
+{full_conversation_text}"""
+
+    def _validate_report(self, raw_response):
+        """Returns (report, None) for a usable response, otherwise (None, reason)."""
+        if raw_response.startswith("Error:"):
+            return None, raw_response
+        try:
+            clean_response = raw_response.strip().replace('```json', '').replace('```', '')
+            report = StructuredPitchReport.model_validate_json(clean_response)
+        except ValueError as e:
+            return None, str(e)
+        missing = set(PILLARS_CONFIG) - {pillar.name for pillar in report.pillars}
+        if missing:
+            return None, f"Missing pillars: {sorted(missing)}"
+        return report, None
+
+    async def analyze_pitch(self, on_section=None):
+        full_conversation_text = self._format_history_for_analysis()
+        raw_response = await self._get_analysis_from_gemini(self._build_structured_prompt(full_conversation_text), generation_config=self.generation_config)
+        report, error = self._validate_report(raw_response)
+        for _ in range(ANALYSIS_REPAIR_ATTEMPTS):
+            if report or raw_response.startswith("Error:"):
+                break
+            repair_prompt = f"""The JSON below was supposed to be a pitch analysis report but failed validation.
+**Validation error**: {error}
+**Required pillar names**: {list(PILLARS_CONFIG.keys())}
+Fix it and return ONLY the corrected JSON object. Scores are integers from 1 to 5 and 'top_3_areas' has at most 3 items.
+**Invalid JSON:**
+{raw_response}"""
+            raw_response = await self._get_analysis_from_gemini(repair_prompt, generation_config=self.generation_config)
+            report, error = self._validate_report(raw_response)
+        if not report:
+            print(f"Structured analysis failed ({error}). Falling back to multi-call engine.")
+            return await super().analyze_pitch(on_section)
+
+        pillars = {pillar.name: pillar for pillar in report.pillars}
+        self.analysis_results["default_alive_dead"] = report.default_alive_dead.strip()
+        self.analysis_results["pillars"] = {
+            name: {"score": pillars[name].score, "feedback": [line.strip() for line in pillars[name].feedback if line.strip()]}
+            for name in PILLARS_CONFIG
+        }
+        self.analysis_results["brutal_feedback"] = [line.strip() for line in report.brutal_feedback if line.strip()]
+        self.analysis_results["top_3_areas"] = [line.strip() for line in report.top_3_areas if line.strip()]
+
+        await self._publish_section(on_section, "default_alive_dead", self.analysis_results["default_alive_dead"])
+        for name, pillar in self.analysis_results["pillars"].items():
+            await self._publish_section(on_section, "pillar", pillar, name)
+        await self._publish_section(on_section, "brutal_feedback", self.analysis_results["brutal_feedback"])
+        await self._publish_section(on_section, "top_3_areas", self.analysis_results["top_3_areas"])
         return self.analysis_results
 
+def create_pitch_analyzer(conversation_history, transcript: Optional[ConversationTranscript] = None) -> PitchAnalyzer:
+    if ANALYSIS_ENGINE == "structured":
+        return StructuredPitchAnalyzer(conversation_history, transcript)
+    return PitchAnalyzer(conversation_history, transcript)
+
 # --- SESSION MANAGEMENT ---
 def save_session_to_firestore(user_uid, session_id, report_data):
     if not fb_db:
@@ -362,6 +804,7 @@ def save_session_to_firestore(user_uid, session_id, report_data):
         print(f"Session for user {user_uid}, session {session_id} saved to Firestore.")
     except Exception as e:
         print(f"Error saving session to Firestore: {e}")
+        raise
 
 def get_history_from_firestore(user_uid):
     if not fb_db:
@@ -383,34 +826,288 @@ def get_history_from_firestore(user_uid):
         print(f"Error reading history from Firestore: {e}")
         return []
 
+# --- REPORT JOBS ---
+# End-of-session reports run on a small worker pool instead of inside the WebSocket handler,
+# so they survive the founder closing the tab. Job state is written to disk on every
+# transition; unfinished jobs are picked up again when the server restarts. Each step's
+# output is checkpointed, so a retry only redoes the step that failed.
+REPORT_JOB_DIR = os.path.join(STORAGE_DIR, "report_jobs")
+REPORT_JOB_WORKERS = int(os.environ.get("REPORT_JOB_WORKERS", "2"))
+REPORT_JOB_MAX_ATTEMPTS = int(os.environ.get("REPORT_JOB_MAX_ATTEMPTS", "3"))
+REPORT_JOB_RETENTION_DAYS = int(os.environ.get("REPORT_JOB_RETENTION_DAYS", "7"))  # 0 keeps finished jobs forever.
+REPORT_JOB_SWEEP_INTERVAL_SECONDS = int(os.environ.get("REPORT_JOB_SWEEP_INTERVAL_SECONDS", str(6 * 3600)))
+os.makedirs(REPORT_JOB_DIR, exist_ok=True)
+
+async def build_analysis_report(job: dict, on_section=None) -> dict:
+    mode = job["report_data"].get("mode")
+    if mode == "strict":
+        analyzer = create_pitch_analyzer(job["history"])
+        return await analyzer.analyze_pitch(on_section=on_section)
+    return {"message": f"{str(mode).capitalize()} session completed."}
+
+class ReportJobManager:
+    def __init__(self, job_dir: str = REPORT_JOB_DIR, num_workers: int = REPORT_JOB_WORKERS, max_attempts: int = REPORT_JOB_MAX_ATTEMPTS):
+        self.job_dir = job_dir
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self.jobs: Dict[str, dict] = {}  # Unfinished jobs only; finished ones are read back from disk.
+        self.listeners: Dict[str, list] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+        self.retry_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.sweeper: Optional[asyncio.Task] = None
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.job_dir, f"{job_id}.json")
+
+    def _write_job(self, job: dict):
+        tmp_path = self._job_path(job["job_id"]) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._job_path(job["job_id"]))
+
+    async def _persist(self, job: dict):
+        job["updated_at"] = datetime.now().isoformat()
+        try:
+            await run_in_threadpool(self._write_job, job)
+        except Exception as e:
+            print(f"Could not persist report job {job['job_id']}: {e}")
+
+    def start(self):
+        if self.workers:
+            return
+        self.queue = asyncio.Queue()
+        for filename in os.listdir(self.job_dir):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.job_dir, filename)) as f:
+                    job = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Skipping unreadable report job {filename}: {e}")
+                continue
+            if job.get("status") in ("queued", "running"):
+                job["status"] = "queued"
+                self.jobs[job["job_id"]] = job
+                self.queue.put_nowait(job["job_id"])
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(max(1, self.num_workers))]
+        self.sweeper = asyncio.create_task(self._sweep_loop())
+        print(f"Report job workers started ({len(self.workers)}), {len(self.jobs)} job(s) resumed.")
+
+    async def stop(self):
+        # Jobs waiting out a retry backoff stay "queued" on disk and resume on the next start.
+        for timer in self.retry_timers.values():
+            timer.cancel()
+        self.retry_timers.clear()
+        tasks = self.workers + ([self.sweeper] if self.sweeper else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self.sweeper = None
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                removed = await run_in_threadpool(self.sweep)
+                if removed:
+                    print(f"Report job retention: removed {removed} finished jobs older than {REPORT_JOB_RETENTION_DAYS} days.")
+            except Exception as e:
+                print(f"Report job retention sweep failed: {e}")
+            await asyncio.sleep(REPORT_JOB_SWEEP_INTERVAL_SECONDS)
+
+    def sweep(self) -> int:
+        """Deletes finished (done/failed) job files last written before the retention cutoff."""
+        if REPORT_JOB_RETENTION_DAYS <= 0:
+            return 0
+        cutoff = time.time() - REPORT_JOB_RETENTION_DAYS * 86400
+        removed = 0
+        for entry in os.scandir(self.job_dir):
+            job_id = entry.name.split(".", 1)[0]
+            if not entry.name.endswith((".json", ".tmp")) or job_id in self.jobs or entry.stat().st_mtime >= cutoff:
+                continue
+            _remove_quietly(entry.path)
+            removed += entry.name.endswith(".json")
+        return removed
+
+    async def submit(self, user_uid: Optional[str], session_id: str, history: List[Dict], report_data: dict, listener=None) -> str:
+        self.start()
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id, "user_uid": user_uid, "session_id": session_id, "status": "queued",
+            "attempts": 0, "error": None, "history": list(history), "report_data": report_data,
+            "analysis_report": None, "saved": False, "result": None,
+            "created_at": datetime.now().isoformat(),
+        }
+        self.jobs[job_id] = job
+        if listener:
+            self.subscribe(job_id, listener)
+        await self._persist(job)
+        self.queue.put_nowait(job_id)
+        return job_id
+
+    def subscribe(self, job_id: str, listener):
+        """listener(frame) is awaited with every analysis_section / analysis_report / analysis_job_failed frame."""
+        self.listeners.setdefault(job_id, []).append(listener)
+
+    def unsubscribe(self, job_id: str, listener):
+        if listener in self.listeners.get(job_id, []):
+            self.listeners[job_id].remove(listener)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        try:
+            async with aiofiles.open(self._job_path(job_id), "r") as f:
+                return json.loads(await f.read())
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    async def _notify(self, job_id: str, frame: dict):
+        frame = {**frame, "job_id": job_id}
+        for listener in list(self.listeners.get(job_id, [])):
+            try:
+                await listener(frame)
+            except Exception as e:
+                print(f"Dropping listener for report job {job_id}: {e}")
+                self.unsubscribe(job_id, listener)
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._run(self.jobs[job_id])
+            except Exception as e:
+                print(f"Report job worker error on {job_id}: {e}"); traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def _requeue(self, job_id: str):
+        self.retry_timers.pop(job_id, None)
+        self.queue.put_nowait(job_id)
+
+    async def _run(self, job: dict):
+        job_id = job["job_id"]
+        job["status"] = "running"
+        job["attempts"] += 1
+        await self._persist(job)
+
+        async def on_section(section, data, name=None):
+            frame = {"type": "analysis_section", "section": section, "data": data}
+            if name:
+                frame["name"] = name
+            await self._notify(job_id, frame)
+
+        try:
+            if job.get("analysis_report") is None:
+                job["analysis_report"] = await build_analysis_report(job, on_section=on_section)
+                await self._persist(job)
+            report_data = {**job["report_data"], "analysis_report": job["analysis_report"]}
+            if job.get("user_uid") and fb_db and not job.get("saved"):
+                await run_in_threadpool(save_session_to_firestore, job["user_uid"], job["session_id"], report_data)
+                job["saved"] = True
+        except Exception as e:
+            job["error"] = str(e)
+            print(f"Report job {job_id} failed (attempt {job['attempts']}/{self.max_attempts}): {e}")
+            if job["attempts"] < self.max_attempts:
+                job["status"] = "queued"
+                await self._persist(job)
+                # Back off on the event loop rather than holding a worker for the delay.
+                self.retry_timers[job_id] = asyncio.get_running_loop().call_later(2 ** job["attempts"], self._requeue, job_id)
+                return
+            job["status"] = "failed"
+            await self._persist(job)
+            await self._notify(job_id, {"type": "analysis_job_failed", "text": "Could not generate the report. Please try again later."})
+        else:
+            job.update(status="done", error=None, result=report_data)
+            await self._persist(job)
+            await self._notify(job_id, {"type": "analysis_report", "data": report_data})
+        self.jobs.pop(job_id, None)
+        self.listeners.pop(job_id, None)
+
+report_jobs = ReportJobManager()
+
+@app.on_event("startup")
+async def start_report_jobs():
+    report_jobs.start()
+
+
+# --- PERSONA MODEL REGISTRY ---
+# Persona system prompts never change, so one GenerativeModel per persona is shared by every
+# connection. A connection only holds chat history, created when that investor first speaks.
+persona_models: Dict[str, genai.GenerativeModel] = {}
+
+def get_persona_model(name: str) -> Optional[genai.GenerativeModel]:
+    if name not in persona_models:
+        if not GEMINI_API_KEY or name not in INVESTOR_PERSONAS:
+            return None
+        persona_models[name] = genai.GenerativeModel(
+            model_name="gemini-1.5-pro-latest",
+            system_instruction=INVESTOR_PERSONAS[name]["system_prompt"]
+        )
+    return persona_models[name]
+
+if GEMINI_API_KEY:
+    try:
+        for persona_name in INVESTOR_PERSONAS:
+            get_persona_model(persona_name)
+        print(f"Persona model registry initialized ({len(persona_models)} personas).")
+    except Exception as e:
+        print(f"ERROR: Could not initialize persona models: {e}")
+
+class InvestorChats:
+    """Per-connection investor chat sessions, built lazily from the shared persona models."""
+    def __init__(self, investor_names: List[str]):
+        self.investor_names = list(investor_names)
+        self._sessions: Dict[str, Any] = {}
+    def __contains__(self, name):
+        return name in self.investor_names
+    def __iter__(self):
+        return iter(self.investor_names)
+    def __len__(self):
+        return len(self.investor_names)
+    def __getitem__(self, name):
+        if name not in self._sessions:
+            model = get_persona_model(name) if name in self.investor_names else None
+            if model is None:
+                raise KeyError(name)
+            self._sessions[name] = model.start_chat(history=[])
+        return self._sessions[name]
+    def __setitem__(self, name, chat_session):
+        self._sessions[name] = chat_session
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: dict[WebSocket, dict] = {}
         self.investor_names = list(INVESTOR_PERSONAS.keys())
     def initialize_investors(self):
         if not GEMINI_API_KEY: return None
-        investor_chats = {}
-        for name, persona in INVESTOR_PERSONAS.items():
-            model_instance = genai.GenerativeModel(
-                model_name="gemini-1.5-pro-latest", 
-                system_instruction=persona["system_prompt"]
-            )
-            investor_chats[name] = model_instance.start_chat(history=[])
-        return investor_chats
+        return InvestorChats(self.investor_names)
     async def connect(self, websocket: WebSocket, user_uid: str = None):
         await websocket.accept()
+        transcript = ConversationTranscript()
         self.active_connections[websocket] = {
             "user_uid": user_uid,
             "investor_chats": self.initialize_investors(),
             "investor_turn_index": 0, # Kept for fallback
-            "conversation_history": [],
+            "transcript": transcript,
+            "conversation_history": transcript.entries,
             "last_investor_name": None,
             "startup_details": None,
             "deck_context": None, # NEW: To store deck text
             "initial_context_sent": False,
             "mode": "strict",
+            "stream_replies": STREAM_INVESTOR_REPLIES,
             "opening_evaluated": False,
             "current_session_id": f"session_{datetime.now().timestamp()}",
+            "report_job_ids": [],
         }
     def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
@@ -421,14 +1118,15 @@ class ConnectionManager:
     def reset_session_state(self, websocket: WebSocket):
         conn_data = self.get_connection_data(websocket)
         if conn_data:
-            conn_data["conversation_history"] = []
+            conn_data["transcript"] = ConversationTranscript()
+            conn_data["conversation_history"] = conn_data["transcript"].entries
             conn_data["last_investor_name"] = None
             conn_data["startup_details"] = None
             conn_data["deck_context"] = None # NEW: Reset deck context
             conn_data["initial_context_sent"] = False
             conn_data["opening_evaluated"] = False
             conn_data["mode"] = "strict"
-            # Re-initializing investors clears their chat history
+            # A fresh InvestorChats drops every investor's chat history
             conn_data["investor_chats"] = self.initialize_investors()
             conn_data["investor_turn_index"] = 0
             print(f"Server-side session state reset for websocket: {websocket.client}")
@@ -446,8 +1144,180 @@ class ConnectionManager:
         return investor_name
 manager = ConnectionManager()
 
+# --- TURN SCHEDULER ---
+# Moderation, opening evaluation and speaker selection are independent Gemini calls, so a
+# founder turn starts them together and speculatively drafts the most likely investor's reply
+# in the meantime. The draft is thrown away if a gate fails or a different investor is chosen.
+SPECULATIVE_REPLIES_ENABLED = os.environ.get("SPECULATIVE_REPLIES_ENABLED", "true").lower() == "true"
+# Default for clients that don't say; a client opts in or out with `stream` in startup_details.
+STREAM_INVESTOR_REPLIES = os.environ.get("STREAM_INVESTOR_REPLIES", "false").lower() == "true"
+TERMINATE_PREFIX = "[TERMINATE_SESSION]"
+
+def predict_next_speaker(composed_text: str, last_investor_name: Optional[str], investor_names: List[str]) -> Optional[str]:
+    """Cheap guess at who will answer, used only to start the speculative reply."""
+    local_choice, _ = route_speaker_locally(composed_text, investor_names, last_investor_name)
+    if local_choice:
+        return local_choice
+    if last_investor_name in investor_names:
+        return last_investor_name
+    return investor_names[0] if investor_names else None
+
+def build_investor_prompt(conn_data: dict, composed_text: str):
+    """Returns the prompt for the investor and whether it carries the deck context."""
+    if not conn_data['initial_context_sent'] and conn_data['deck_context']:
+        return f"CONTEXT FROM PITCH DECK:\n---\n{conn_data['deck_context']}\n---\nFOUNDER'S RESPONSE:\n{composed_text}", True
+    return composed_text, False
+
+def _discard_task(task: Optional[asyncio.Task]):
+    # Threadpool work cannot be interrupted, so we only stop waiting on it and drop its result.
+    if task and not task.done():
+        task.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+class InvestorReplyDraft:
+    """
+    An investor reply generated on a fresh chat session seeded with the live history, so it
+    can be discarded without touching the original. In streaming mode the text chunks are queued as
+    they arrive and can be forwarded once the draft is accepted.
+    """
+    def __init__(self, chat_session, prompt: str, stream: bool = False):
+        # A shallow copy would share `_history` and the pending last exchange with the live
+        # session; reading `history` folds that exchange in before we take our own list.
+        self.session = chat_session.model.start_chat(history=list(chat_session.history))
+        self.stream = stream
+        self.chunks: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._generate(prompt))
+
+    async def _generate(self, prompt: str) -> str:
+        try:
+            if not self.stream:
+                response = await run_in_threadpool(self.session.send_message, prompt)
+                return response.text.strip()
+            response = await run_in_threadpool(self.session.send_message, prompt, stream=True)
+            chunk_iter = iter(response)
+            parts = []
+            while (chunk := await run_in_threadpool(next, chunk_iter, None)) is not None:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue  # Chunk without text parts (e.g. the final finish_reason chunk).
+                parts.append(text)
+                self.chunks.put_nowait(text)
+            return "".join(parts).strip()
+        finally:
+            self.chunks.put_nowait(None)
+
+    async def iter_chunks(self):
+        while (text := await self.chunks.get()) is not None:
+            yield text
+
+    def discard(self):
+        _discard_task(self.task)
+
+async def deliver_investor_reply(websocket: WebSocket, conn_data: dict, investor_name: str, draft: InvestorReplyDraft) -> str:
+    """
+    Sends the draft to the client and commits it to the investor's chat and the transcript.
+    Streaming clients get `investor_delta` frames and a closing `investor_done`; everyone
+    else gets the single `investor` frame. Returns the reply without the terminate prefix.
+    """
+    terminated = False
+    if draft.stream:
+        pending = ""
+        prefix_checked = False
+        async for text in draft.iter_chunks():
+            if not prefix_checked:
+                # Hold back the first tokens until we know whether they spell the terminate command.
+                pending += text
+                stripped = pending.lstrip()
+                if len(stripped) < len(TERMINATE_PREFIX) and TERMINATE_PREFIX.startswith(stripped):
+                    continue
+                prefix_checked = True
+                if stripped.startswith(TERMINATE_PREFIX):
+                    terminated = True
+                    stripped = stripped[len(TERMINATE_PREFIX):].lstrip()
+                text = stripped
+            if text:
+                await websocket.send_json({"type": "investor_delta", "investor_name": investor_name, "text": text})
+        if not prefix_checked and pending.strip():
+            await websocket.send_json({"type": "investor_delta", "investor_name": investor_name, "text": pending.lstrip()})
+    raw_response_text = await draft.task
+
+    trim_chat_history(draft.session)
+    conn_data["investor_chats"][investor_name] = draft.session
+    conn_data['transcript'].append(investor_name, raw_response_text)
+    conn_data['last_investor_name'] = investor_name
+
+    terminated = terminated or raw_response_text.startswith(TERMINATE_PREFIX)
+    final_text_to_send = raw_response_text.replace(TERMINATE_PREFIX, "").strip() if terminated else raw_response_text
+    if draft.stream:
+        await websocket.send_json({"type": "investor_done", "investor_name": investor_name, "text": final_text_to_send})
+    else:
+        await websocket.send_json({"type": "investor", "investor_name": investor_name, "text": final_text_to_send})
+    if terminated:
+        await websocket.send_json({"type": "session_terminated", "reason": final_text_to_send})
+    return final_text_to_send
+
+async def run_founder_turn(websocket: WebSocket, conn_data: dict, composed_text: str):
+    investor_chats = conn_data["investor_chats"]
+    stream = conn_data.get("stream_replies", STREAM_INVESTOR_REPLIES)
+    moderation_task = asyncio.create_task(check_for_inappropriate_content(composed_text, moderation_model))
+    opening_task = None
+    if conn_data['mode'] == 'strict' and not conn_data.get('opening_evaluated'):
+        opening_task = asyncio.create_task(evaluate_pitch_opening(composed_text, pitch_eval_model))
+    speaker_task = asyncio.create_task(choose_next_speaker(conn_data['transcript'], manager.investor_names, conn_data.get('last_investor_name')))
+
+    prompt, uses_deck_context = build_investor_prompt(conn_data, composed_text)
+    predicted_name = predict_next_speaker(composed_text, conn_data.get('last_investor_name'), manager.investor_names)
+    speculative_draft = None
+    if SPECULATIVE_REPLIES_ENABLED and predicted_name in investor_chats:
+        speculative_draft = InvestorReplyDraft(investor_chats[predicted_name], prompt, stream=stream)
+
+    draft = None
+    try:
+        is_safe, reason = await moderation_task
+        if not is_safe:
+            await websocket.send_json({"type": "session_terminated", "text": "This is a waste of time. The meeting is over.", "reason": reason})
+            return
+
+        if opening_task:
+            conn_data['opening_evaluated'] = True
+            decision, reason = await opening_task
+            if decision == 'TERMINATE':
+                final_text_to_send = "I don't understand what you do. If you can't explain it clearly, there's no point in continuing. Meeting's over."
+                conn_data['transcript'].append('Alex Chen', f"[TERMINATE_SESSION] {final_text_to_send}")
+                await websocket.send_json({"type": "session_terminated", "reason": final_text_to_send})
+                return
+
+        investor_name = await speaker_task
+        if not investor_name:
+            investor_name = manager.get_next_investor_fallback(websocket)
+
+        if not investor_name or not investor_chats.get(investor_name):
+            await websocket.send_json({"type": "error", "text": "No available investors to respond."})
+            return
+
+        if speculative_draft and investor_name == predicted_name:
+            # A failed speculative call surfaces through deliver_investor_reply just like a direct one.
+            draft, speculative_draft = speculative_draft, None
+            print(f"Using speculative reply from {investor_name}.")
+        else:
+            draft = InvestorReplyDraft(investor_chats[investor_name], prompt, stream=stream)
+    finally:
+        for task in (moderation_task, opening_task, speaker_task):
+            _discard_task(task)
+        if speculative_draft:
+            speculative_draft.discard()
+
+    if uses_deck_context:
+        conn_data['initial_context_sent'] = True
+    await deliver_investor_reply(websocket, conn_data, investor_name, draft)
+
+
 # --- LOGIC MIGRATED FROM PITCH DECK ANALYZER (PROJECT 1) ---
 
+# Part of every deck analysis cache key; bump it whenever the analysis or welcome prompts change.
+DECK_ANALYSIS_PROMPT_VERSION = "3"
+
 def analyze_deck_with_gemini(deck_text: str) -> dict:
     if not gemini_pro_model: return {"error": "Gemini Pro model not available."}
     prompt = """
@@ -599,6 +1469,1045 @@ def chat_with_gemini(history: list, topic: str, analysis: dict) -> str:
         return "There was an error."
 
 
+# --- Deck processing pools ---
+# PDF parsing is CPU-bound and runs in a small process pool; Gemini calls block on network I/O
+# and run in their own thread pool, so neither stalls the event loop serving live sessions.
+# At most DECK_MAX_IN_FLIGHT analyses and DECK_CHAT_MAX_IN_FLIGHT deck chat replies are
+# admitted; beyond that /api/analyze and /api/chat answer 429.
+DECK_PARSE_WORKERS = int(os.environ.get("DECK_PARSE_WORKERS", "2"))
+DECK_MODEL_WORKERS = int(os.environ.get("DECK_MODEL_WORKERS", "8"))
+DECK_MAX_IN_FLIGHT = int(os.environ.get("DECK_MAX_IN_FLIGHT", "8"))
+DECK_CHAT_MAX_IN_FLIGHT = int(os.environ.get("DECK_CHAT_MAX_IN_FLIGHT", "32"))
+DECK_RETRY_AFTER_SECONDS = 30
+DECK_CHAT_RETRY_AFTER_SECONDS = 5
+# Worker processes must not be forked from the server: the child would inherit the gRPC and
+# Firebase client threads' locks mid-flight. "spawn" also works, at a slower pool start.
+PROCESS_POOL_START_METHOD = os.environ.get("PROCESS_POOL_START_METHOD", "forkserver")
+# Extraction limits: appendix-heavy decks are cut off rather than parsed in full.
+DECK_MAX_BYTES = int(os.environ.get("DECK_MAX_BYTES", str(25 * 1024 * 1024)))
+DECK_MAX_PAGES = int(os.environ.get("DECK_MAX_PAGES", "60"))
+DECK_MAX_CHARS = int(os.environ.get("DECK_MAX_CHARS", "200000"))
+DECK_PAGES_PER_TASK = int(os.environ.get("DECK_PAGES_PER_TASK", "8"))
+
+def extract_deck_pages(pdf_path: str, start: int, stop: int, max_chars: int) -> tuple:
+    """
+    Returns (page_count, texts of pages [start, stop) that exist). Each worker opens the document
+    from disk, so only the path crosses the process boundary.
+    """
+    if not os.path.exists(pdf_path):
+        return 0, []  # A range that could not be cancelled in time; the caller has moved on.
+    pages = []
+    chars = 0
+    with fitz.open(pdf_path, filetype="pdf") as pdf_document:
+        for page_number in range(start, min(stop, pdf_document.page_count)):
+            pages.append(pdf_document[page_number].get_text())
+            chars += len(pages[-1])
+            if chars >= max_chars:
+                break
+        return pdf_document.page_count, pages
+
+def _write_temp_pdf(pdf_content: bytes) -> str:
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="deck-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(pdf_content)
+    return path
+
+class DeckProcessingPool:
+    def __init__(self, parse_workers: int = DECK_PARSE_WORKERS, model_workers: int = DECK_MODEL_WORKERS, max_in_flight: int = DECK_MAX_IN_FLIGHT):
+        self.parse_workers = parse_workers
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.chats_in_flight = 0
+        self.parse_pool: Optional[ProcessPoolExecutor] = None
+        self.model_pool = ThreadPoolExecutor(max_workers=model_workers, thread_name_prefix="deck-model")
+
+    def admit(self):
+        """Reserves a slot for one analysis, or raises 429 when the pools are saturated."""
+        if self.in_flight >= self.max_in_flight:
+            raise HTTPException(status_code=429, detail="Deck analysis is busy, please retry shortly.",
+                                headers={"Retry-After": str(DECK_RETRY_AFTER_SECONDS)})
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+    def admit_chat(self):
+        """Like admit(), for the short deck chat replies that share the model pool."""
+        if self.chats_in_flight >= DECK_CHAT_MAX_IN_FLIGHT:
+            raise HTTPException(status_code=429, detail="Deck chat is busy, please retry shortly.",
+                                headers={"Retry-After": str(DECK_CHAT_RETRY_AFTER_SECONDS)})
+        self.chats_in_flight += 1
+
+    def release_chat(self):
+        self.chats_in_flight -= 1
+
+    def get_parse_pool(self) -> ProcessPoolExecutor:
+        if self.parse_pool is None:
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                                  mp_context=multiprocessing.get_context(PROCESS_POOL_START_METHOD))
+        return self.parse_pool
+
+    async def run_parse(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_parse_pool(), func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. a malformed PDF crashed the parser); start a fresh pool next time.
+            self.parse_pool = None
+            raise HTTPException(status_code=503, detail="Deck parser is restarting, please retry.",
+                                headers={"Retry-After": "5"})
+
+    async def extract_text(self, pdf_content: bytes) -> dict:
+        """
+        Extracts deck text with page ranges spread across the parse pool. The PDF is written to a
+        temp file once and workers open it by path. The first range also reports the page count;
+        the rest are then fanned out, consumed in order and cancelled once DECK_MAX_CHARS is
+        reached. Returns the page texts, the document's page count and whether it was cut.
+        """
+        pdf_path = await run_in_threadpool(_write_temp_pdf, pdf_content)
+        futures = []
+        pages: List[str] = []
+        length = 0
+        cut = False
+        try:
+            loop = asyncio.get_running_loop()
+            pool = self.get_parse_pool()
+            first = loop.run_in_executor(pool, extract_deck_pages, pdf_path, 0, min(DECK_PAGES_PER_TASK, DECK_MAX_PAGES), DECK_MAX_CHARS)
+            futures.append(first)
+            page_count, _ = await first
+            pages_to_read = min(page_count, DECK_MAX_PAGES)
+            futures += [loop.run_in_executor(pool, extract_deck_pages, pdf_path, start, min(start + DECK_PAGES_PER_TASK, pages_to_read), DECK_MAX_CHARS)
+                        for start in range(DECK_PAGES_PER_TASK, pages_to_read, DECK_PAGES_PER_TASK)]
+            for future in futures:
+                for page_text in (await future)[1]:
+                    if length >= DECK_MAX_CHARS:
+                        break
+                    cut = len(page_text) > DECK_MAX_CHARS - length
+                    pages.append(page_text[:DECK_MAX_CHARS - length])
+                    length += len(pages[-1])
+                if length >= DECK_MAX_CHARS:
+                    break
+        except BrokenProcessPool:
+            self.parse_pool = None
+            raise HTTPException(status_code=503, detail="Deck parser is restarting, please retry.",
+                                headers={"Retry-After": "5"})
+        finally:
+            for future in futures:
+                future.cancel()
+            # Cancelled ranges never open the file; ones already running hold their own handle.
+            _remove_quietly(pdf_path)
+        return {"pages": pages, "page_count": page_count, "truncated": cut or len(pages) < page_count}
+
+    async def run_model(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.model_pool, func, *args)
+
+    def close(self):
+        if self.parse_pool:
+            self.parse_pool.shutdown(wait=False, cancel_futures=True)
+            self.parse_pool = None
+        self.model_pool.shutdown(wait=False, cancel_futures=True)
+
+deck_processing = DeckProcessingPool()
+
+# --- Deck text compaction ---
+# Deck text is sent with every deck-aware model call, so it is cleaned up once after extraction:
+# page numbers, headers/footers repeated across slides and legal boilerplate are dropped, and
+# whitespace is collapsed. The result is then fitted to a token budget slide by slide.
+DECK_ANALYSIS_TOKEN_BUDGET = int(os.environ.get("DECK_ANALYSIS_TOKEN_BUDGET", "8000"))
+DECK_CONTEXT_TOKEN_BUDGET = int(os.environ.get("DECK_CONTEXT_TOKEN_BUDGET", "3000"))
+# "Page 7", "Slide 7", "7 / 24" or "7 of 24"; a bare number only counts if it is the page's own index.
+PAGE_NUMBER_LINE = re.compile(r"^(?:(?:page|slide)\s*(\d{1,3})|(\d{1,3})\s*(?:/|of)\s*\d{1,3}|(\d{1,3}))$", re.IGNORECASE)
+BOILERPLATE_LINE = re.compile(r"^(?:©|\(c\)|copyright\b)|confidential|all rights reserved|do not (?:distribute|share|copy)|for discussion purposes only", re.IGNORECASE)
+BOILERPLATE_MAX_CHARS = 120  # Longer lines are content that merely mentions these words.
+SLIDE_MARKER = re.compile(r"^\[Slide (\d+)\]$", re.MULTILINE)
+
+def is_page_number_line(line: str, page_number: int) -> bool:
+    match = PAGE_NUMBER_LINE.match(line)
+    return bool(match) and (match.group(3) is None or int(match.group(3)) == page_number)
+
+def compact_deck_pages(pages: List[str]) -> List[str]:
+    page_lines = [[re.sub(r"\s+", " ", line).strip() for line in page.splitlines()] for page in pages]
+    page_lines = [[line for line in lines if line] for lines in page_lines]
+
+    # A line on at least half of the slides (ignoring a page number at either end, as in
+    # "Acme Robotics | 7") is a header or footer; it is kept where it first appears only.
+    def shape(line: str) -> str:
+        return re.sub(r"^\d{1,3}\s*[|·•–-]?\s*|\s*[|·•–-]?\s*\d{1,3}$", "", line.lower())
+    pages_with_line: Dict[str, int] = {}
+    for lines in page_lines:
+        for key in {shape(line) for line in lines}:
+            pages_with_line[key] = pages_with_line.get(key, 0) + 1
+    repeated_threshold = max(3, math.ceil(len(pages) / 2))
+    seen_repeated = set()
+
+    compacted = []
+    for page_number, lines in enumerate(page_lines, start=1):
+        kept = []
+        for position, line in enumerate(lines):
+            # Page numbers sit at the top or bottom of a slide; numbers in the body are metrics.
+            if position in (0, len(lines) - 1) and is_page_number_line(line, page_number):
+                continue
+            if len(line) <= BOILERPLATE_MAX_CHARS and BOILERPLATE_LINE.search(line):
+                continue
+            key = shape(line)
+            if key and pages_with_line[key] >= repeated_threshold:
+                if key in seen_repeated:
+                    continue
+                seen_repeated.add(key)
+            kept.append(line)
+        compacted.append("\n".join(kept))
+    return compacted
+
+def _truncate_slide(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    lines, used = [], 0
+    for line in text.split("\n"):
+        if used + len(line) + 1 > max_chars:
+            if not lines:
+                lines.append(line[:max(0, max_chars - 1)])  # Keep at least part of the title.
+            break
+        lines.append(line)
+        used += len(line) + 1
+    return "\n".join(lines) + " …"
+
+def fit_deck_pages(pages: List[str], budget_tokens: int) -> List[str]:
+    """
+    Fits slides into budget_tokens. Every slide gets an equal share and slides that need less
+    pass the surplus on, so long appendix slides are trimmed (from the bottom, at line
+    boundaries) before short slides lose anything.
+    """
+    costs = [estimate_tokens(page) + 3 for page in pages]  # +3 for the slide marker.
+    if sum(costs) <= budget_tokens:
+        return pages
+    allowance = [0] * len(pages)
+    remaining = budget_tokens
+    order = sorted(range(len(pages)), key=lambda i: costs[i])
+    for position, i in enumerate(order):
+        allowance[i] = min(costs[i], remaining // (len(pages) - position))
+        remaining -= allowance[i]
+    return [page if allowance[i] >= costs[i] else _truncate_slide(page, (allowance[i] - 3) * 4)
+            for i, page in enumerate(pages)]
+
+def join_deck_pages(pages: List[str]) -> tuple:
+    """Joins slides under [Slide N] markers. Returns the text and where each page starts in it."""
+    parts, offsets, length = [], [], 0
+    for number, page in enumerate(pages, start=1):
+        offsets.append(length)
+        if not page.strip():
+            continue  # Image-only slides cost nothing.
+        parts.append(f"[Slide {number}]\n{page}")
+        length += len(parts[-1]) + 2
+    return "\n\n".join(parts), offsets
+
+def prepare_deck_text(pages: List[str], budget_tokens: int = DECK_ANALYSIS_TOKEN_BUDGET) -> tuple:
+    return join_deck_pages(fit_deck_pages(compact_deck_pages(pages), budget_tokens))
+
+def fit_deck_text(deck_text: str, budget_tokens: int) -> str:
+    """Compacts and budgets deck text from a client, e.g. a profile saved before compaction existed."""
+    markers = list(SLIDE_MARKER.finditer(deck_text))
+    if not markers:
+        pages = [deck_text]
+    else:
+        bounds = [m.start() for m in markers] + [len(deck_text)]
+        # Slide numbers come from the client, so anything past DECK_MAX_PAGES is ignored.
+        slides = {int(marker.group(1)): deck_text[marker.end():end].strip()
+                  for marker, end in zip(markers, bounds[1:]) if 1 <= int(marker.group(1)) <= DECK_MAX_PAGES}
+        pages = [slides.get(number, "") for number in range(1, max(slides, default=0) + 1)]
+    return join_deck_pages(fit_deck_pages(compact_deck_pages(pages), budget_tokens))[0]
+
+
+# --- Deck analysis cache ---
+# Results are keyed by the SHA-256 of the PDF bytes plus the prompt version, scoped per user.
+# An in-memory LRU serves repeat uploads on this instance; a JSON file per entry survives restarts.
+# A periodic sweep drops expired files and trims the disk tier to DECK_CACHE_DISK_MAX_BYTES,
+# least recently used first (disk hits refresh the file's mtime).
+DECK_CACHE_DIR = os.path.join(STORAGE_DIR, "deck_analysis_cache")
+DECK_CACHE_SIZE = int(os.environ.get("DECK_CACHE_SIZE", "128"))
+DECK_CACHE_TTL_SECONDS = int(os.environ.get("DECK_CACHE_TTL_SECONDS", str(7 * 86400)))
+DECK_CACHE_DISK_MAX_BYTES = int(os.environ.get("DECK_CACHE_DISK_MAX_BYTES", str(200 * 1024 * 1024)))
+DECK_CACHE_SWEEP_INTERVAL_SECONDS = int(os.environ.get("DECK_CACHE_SWEEP_INTERVAL_SECONDS", "3600"))
+os.makedirs(DECK_CACHE_DIR, exist_ok=True)
+
+class DeckAnalysisCache:
+    def __init__(self, cache_dir: str = DECK_CACHE_DIR, maxsize: int = DECK_CACHE_SIZE, ttl: int = DECK_CACHE_TTL_SECONDS,
+                 max_disk_bytes: int = DECK_CACHE_DISK_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = LRUCache(maxsize=maxsize)  # key -> (created_at, result)
+        self.in_progress: Dict[str, asyncio.Future] = {}
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.sweeper: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def key(pdf_content: bytes, user_uid: Optional[str]) -> str:
+        scope = hashlib.sha256((user_uid or "anonymous").encode()).hexdigest()[:16]
+        return f"{scope}-{hashlib.sha256(pdf_content).hexdigest()}-v{DECK_ANALYSIS_PROMPT_VERSION}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read(self, key: str) -> Optional[tuple]:
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["created_at"] > self.ttl:
+            _remove_quietly(self._path(key))
+            return None
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return entry["created_at"], entry["result"]
+
+    def _write(self, key: str, created_at: float, result: dict):
+        tmp_path = f"{self._path(key)}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"created_at": created_at, "result": result}, f)
+        os.replace(tmp_path, self._path(key))
+
+    def start(self):
+        self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    def stop(self):
+        if self.sweeper:
+            self.sweeper.cancel()
+            self.sweeper = None
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                removed = await run_in_threadpool(self.sweep)
+                if removed:
+                    print(f"Deck analysis cache: removed {removed} expired or least recently used entries from disk.")
+            except Exception as e:
+                print(f"Deck analysis cache sweep failed: {e}")
+            await asyncio.sleep(DECK_CACHE_SWEEP_INTERVAL_SECONDS)
+
+    def sweep(self) -> int:
+        """Removes expired entries and abandoned temp files, then evicts until under max_disk_bytes."""
+        now = time.time()
+        entries = []
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat_result = entry.stat()
+            # Entries are written once, so an mtime older than the TTL also means created_at is.
+            if now - stat_result.st_mtime > self.ttl or (entry.name.endswith(".tmp") and now - stat_result.st_mtime > 3600):
+                _remove_quietly(entry.path)
+                removed += 1
+            elif entry.name.endswith(".json"):
+                entries.append((stat_result.st_mtime, entry.path, stat_result.st_size))
+        total = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            _remove_quietly(path)
+            total -= size
+            removed += 1
+        return removed
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self.memory.get(key)
+        if entry and time.time() - entry[0] <= self.ttl:
+            self.stats["memory_hits"] += 1
+            return copy.deepcopy(entry[1])
+        entry = await run_in_threadpool(self._read, key)
+        if entry:
+            self.stats["disk_hits"] += 1
+            self.memory[key] = entry
+            return copy.deepcopy(entry[1])
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, result: dict):
+        entry = (time.time(), copy.deepcopy(result))
+        self.memory[key] = entry
+        try:
+            await run_in_threadpool(self._write, key, *entry)
+        except OSError as e:
+            print(f"Error persisting deck analysis cache entry {key}: {e}")
+
+    async def get_or_compute(self, key: str, compute) -> dict:
+        """Returns the cached result, or runs compute() once even if the same deck arrives concurrently."""
+        cached = await self.get(key)
+        if cached is not None:
+            return cached
+        if key in self.in_progress:
+            return copy.deepcopy(await asyncio.shield(self.in_progress[key]))
+        future = asyncio.get_running_loop().create_future()
+        self.in_progress[key] = future
+        try:
+            result = await compute()
+            await self.put(key, result)
+            future.set_result(result)
+            return copy.deepcopy(result)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so an unawaited failure is not logged.
+            raise
+        finally:
+            self.in_progress.pop(key, None)
+
+deck_analysis_cache = DeckAnalysisCache()
+
+@app.on_event("startup")
+async def start_deck_analysis_cache():
+    deck_analysis_cache.start()
+
+# --- Deck text handles ---
+# Extracted deck text stays on the server under a content ID (deckId). /api/analyze, profiles
+# and the WebSocket pass the ID around instead of sending the text back and forth.
+# Texts live in Firestore (collection DECK_TEXT_COLLECTION) so they survive redeploys; local
+# disk is only used when Firestore is not configured. Each entry carries an expireAt that use
+# pushes forward (at most once per DECK_TEXT_TOUCH_SECONDS); configure a Firestore TTL policy
+# on that field to have abandoned decks deleted.
+DECK_TEXT_DIR = os.path.join(STORAGE_DIR, "deck_texts")
+DECK_TEXT_COLLECTION = "deck_texts"
+DECK_TEXT_TTL_SECONDS = int(os.environ.get("DECK_TEXT_TTL_SECONDS", str(30 * 86400)))
+DECK_TEXT_TOUCH_SECONDS = 86400
+DECK_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+os.makedirs(DECK_TEXT_DIR, exist_ok=True)
+
+class DeckTextStore:
+    def __init__(self, text_dir: str = DECK_TEXT_DIR, maxsize: int = 64, ttl: int = DECK_TEXT_TTL_SECONDS):
+        self.text_dir = text_dir
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize)
+        self.touched = LRUCache(maxsize=4096)  # deck_id -> when its expiry was last pushed forward.
+
+    @staticmethod
+    def deck_id(deck_text: str) -> str:
+        return hashlib.sha256(deck_text.encode()).hexdigest()[:32]
+
+    def _path(self, deck_id: str) -> str:
+        return os.path.join(self.text_dir, f"{deck_id}.txt")
+
+    def _write(self, deck_id: str, deck_text: str):
+        """Stores the text durably, or pushes its expiry forward if it is already stored."""
+        if fb_db:
+            expire_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+            fb_db.collection(DECK_TEXT_COLLECTION).document(deck_id).set({"text": deck_text, "expireAt": expire_at})
+            return
+        path = self._path(deck_id)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(deck_text)
+        os.replace(tmp_path, path)
+
+    def _read(self, deck_id: str) -> Optional[str]:
+        if fb_db:
+            snapshot = fb_db.collection(DECK_TEXT_COLLECTION).document(deck_id).get()
+            if not snapshot.exists:
+                return None
+            entry = snapshot.to_dict()
+            if entry.get("expireAt") and entry["expireAt"] < datetime.now(timezone.utc):
+                return None  # Expired but not yet removed by the TTL policy.
+            return entry.get("text")
+        path = self._path(deck_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                _remove_quietly(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    async def _touch(self, deck_id: str, deck_text: str):
+        if time.time() - self.touched.get(deck_id, 0) < DECK_TEXT_TOUCH_SECONDS:
+            return
+        await run_in_threadpool(self._write, deck_id, deck_text)
+        self.touched[deck_id] = time.time()
+
+    async def put(self, deck_text: str) -> str:
+        """Stores deck text and returns its deckId. Raises if it could not be stored durably."""
+        deck_id = self.deck_id(deck_text)
+        self.memory[deck_id] = deck_text
+        await self._touch(deck_id, deck_text)
+        return deck_id
+
+    async def get(self, deck_id: str) -> Optional[str]:
+        if not isinstance(deck_id, str) or not DECK_ID_PATTERN.match(deck_id):
+            return None
+        deck_text = self.memory.get(deck_id)
+        if deck_text is None:
+            deck_text = await run_in_threadpool(self._read, deck_id)
+            if deck_text is None:
+                return None
+            self.memory[deck_id] = deck_text
+        try:
+            await self._touch(deck_id, deck_text)  # Decks in use do not expire.
+        except Exception as e:
+            print(f"Error extending expiry of deck text {deck_id}: {e}")
+        return deck_text
+
+deck_texts = DeckTextStore()
+
+async def resolve_deck_text(details: dict) -> Optional[str]:
+    """
+    Returns the deck text a client payload refers to via deckId. A legacy inline deckText is
+    stored and, once stored durably, replaced by its deckId in place so that it is not copied
+    into reports or profiles. If storing fails the inline text is left where it is.
+    """
+    if details.get("deckText"):
+        deck_text = await run_in_threadpool(fit_deck_text, details["deckText"], DECK_ANALYSIS_TOKEN_BUDGET)
+        try:
+            details["deckId"] = await deck_texts.put(deck_text)
+            del details["deckText"]
+        except Exception as e:
+            print(f"Error storing deck text; keeping it inline: {e}")
+        return deck_text
+    if details.get("deckId"):
+        deck_text = await deck_texts.get(details["deckId"])
+        if deck_text is None:
+            print(f"Deck text {details['deckId']} not found; continuing without deck context.")
+        return deck_text
+    return None
+
+# --- SPEECH RECOGNITION ---
+SPEECH_MODEL = os.environ.get("SPEECH_MODEL", "chirp")
+# chirp does not support streaming; chirp_2 does in us-central1.
+STREAMING_SPEECH_MODEL = os.environ.get("STREAMING_SPEECH_MODEL", "chirp_2")
+STREAMING_SPEECH_MAX_STREAMS = int(os.environ.get("STREAMING_SPEECH_MAX_STREAMS", "32"))
+STREAMING_SPEECH_END_TIMEOUT = float(os.environ.get("STREAMING_SPEECH_END_TIMEOUT", "1.2"))
+# How long after the audio ends to wait for the final result before sending what we have.
+STREAMING_SPEECH_FINISH_TIMEOUT = float(os.environ.get("STREAMING_SPEECH_FINISH_TIMEOUT", "10"))
+STREAMING_AUDIO_CHUNK_BYTES = 15 * 1024  # Speech v2 rejects larger audio frames on a stream.
+# Streams are long-lived, so they get their own threads instead of holding the shared threadpool.
+streaming_speech_executor = ThreadPoolExecutor(max_workers=STREAMING_SPEECH_MAX_STREAMS, thread_name_prefix="speech-stream")
+
+def build_recognition_config(model: str = SPEECH_MODEL, pcm_sample_rate: Optional[int] = None) -> cloud_speech.RecognitionConfig:
+    """WEBM/Opus as recorded by the browser, or LINEAR16 mono when the audio was decoded server-side."""
+    if pcm_sample_rate:
+        decoding_config = cloud_speech.ExplicitDecodingConfig(encoding=cloud_speech.ExplicitDecodingConfig.AudioEncoding.LINEAR16, sample_rate_hertz=pcm_sample_rate, audio_channel_count=1)
+    else:
+        decoding_config = cloud_speech.ExplicitDecodingConfig(encoding=cloud_speech.ExplicitDecodingConfig.AudioEncoding.WEBM_OPUS, sample_rate_hertz=48000, audio_channel_count=1)
+    features_config = cloud_speech.RecognitionFeatures(enable_automatic_punctuation=True)
+    return cloud_speech.RecognitionConfig(explicit_decoding_config=decoding_config, language_codes=["en-US"], model=model, features=features_config)
+
+# --- Server-side silence trimming ---
+# Uploaded utterances always carry the client's 1.5 s silence tail, and often leading silence.
+# When ffmpeg is installed the blob is decoded to 16 kHz PCM, an energy VAD finds the speech,
+# and only that span (plus padding) is sent. Only blobs that never rise clearly above VAD_MIN_RMS
+# are dropped as silent; when the VAD cannot separate speech from noise the blob is sent untrimmed.
+FFMPEG_PATH = shutil.which("ffmpeg")
+AUDIO_VAD_ENABLED = os.environ.get("AUDIO_VAD_ENABLED", "true").lower() == "true" and bool(FFMPEG_PATH)
+VAD_SAMPLE_RATE = 16000
+VAD_FRAME_MS = 20
+VAD_PADDING_MS = int(os.environ.get("VAD_PADDING_MS", "300"))
+VAD_MIN_SPEECH_MS = int(os.environ.get("VAD_MIN_SPEECH_MS", "200"))
+VAD_MIN_RMS = float(os.environ.get("VAD_MIN_RMS", "300"))
+VAD_NOISE_RATIO = float(os.environ.get("VAD_NOISE_RATIO", "3.0"))
+VAD_EDGE_MS = int(os.environ.get("VAD_EDGE_MS", "300"))  # Leading/trailing audio used to estimate the noise floor.
+VAD_MAX_NOISE_RMS = float(os.environ.get("VAD_MAX_NOISE_RMS", "1000"))
+AUDIO_DECODE_TIMEOUT = float(os.environ.get("AUDIO_DECODE_TIMEOUT", "5"))
+audio_decode_semaphore = asyncio.Semaphore(os.cpu_count() or 2)
+if not AUDIO_VAD_ENABLED:
+    print("Server-side VAD disabled (ffmpeg not found or AUDIO_VAD_ENABLED=false); audio is sent untrimmed.")
+
+async def decode_to_pcm(audio_bytes: bytes) -> Optional[bytes]:
+    """Decodes a WEBM/Opus blob to 16-bit mono PCM at VAD_SAMPLE_RATE, or None on failure."""
+    async with audio_decode_semaphore:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+            "-f", "s16le", "-ac", "1", "-ar", str(VAD_SAMPLE_RATE), "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            pcm, err = await asyncio.wait_for(process.communicate(audio_bytes), timeout=AUDIO_DECODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            print("ERROR: ffmpeg timed out decoding an utterance.")
+            return None
+    if process.returncode != 0:
+        print(f"ERROR: ffmpeg could not decode an utterance: {err.decode(errors='ignore').strip()}")
+        return None
+    return pcm
+
+def find_speech_span(pcm: bytes) -> Optional[tuple]:
+    """Returns the (start, end) byte offsets of the padded speech span, or None if the blob is silent."""
+    samples = array("h")
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    frame_len = VAD_SAMPLE_RATE * VAD_FRAME_MS // 1000
+    energies = [
+        math.sqrt(sum(x * x for x in samples[i:i + frame_len]) / frame_len)
+        for i in range(0, len(samples) - frame_len + 1, frame_len)
+    ]
+    if not energies:
+        return None
+    peak = max(energies)
+    if peak < VAD_MIN_RMS * VAD_NOISE_RATIO:
+        # Nothing ever rises clearly above the absolute floor: treat as silence only if
+        # no frame reaches it at all, otherwise let the recognizer decide.
+        return None if peak < VAD_MIN_RMS else (0, len(samples) * 2)
+    # Leading and trailing audio is where silence is; the quieter edge approximates the noise
+    # floor. The cap keeps a recording that is speech end to end from raising the threshold
+    # above its own speech level.
+    edge_frames = max(1, VAD_EDGE_MS // VAD_FRAME_MS)
+    edges = [sorted(energies[:edge_frames]), sorted(energies[-edge_frames:])]
+    noise_floor = min(VAD_MAX_NOISE_RMS, *(edge[len(edge) // 2] for edge in edges))
+    threshold = max(VAD_MIN_RMS, noise_floor * VAD_NOISE_RATIO)
+    speech_frames = [index for index, energy in enumerate(energies) if energy >= threshold]
+    if len(speech_frames) * VAD_FRAME_MS < VAD_MIN_SPEECH_MS:
+        return 0, len(samples) * 2  # Loud but not separable from the noise: send it untrimmed.
+    padding_frames = VAD_PADDING_MS // VAD_FRAME_MS
+    first = max(0, speech_frames[0] - padding_frames)
+    last = min(len(energies), speech_frames[-1] + 1 + padding_frames)
+    return first * frame_len * 2, last * frame_len * 2
+
+async def prepare_utterance_audio(audio_bytes: bytes, require_pcm: bool = False):
+    """
+    Returns (audio, pcm_sample_rate) ready for recognition, where pcm_sample_rate is None when
+    the original WEBM blob is passed through. Returns None when the blob contains no speech.
+    With require_pcm the blob is always decoded, and a failed decode raises.
+    """
+    if not AUDIO_VAD_ENABLED and not require_pcm:
+        return audio_bytes, None
+    pcm = await decode_to_pcm(audio_bytes) if FFMPEG_PATH else None
+    if not pcm:
+        if require_pcm:
+            raise RuntimeError("Could not decode audio to PCM (is ffmpeg installed?).")
+        return audio_bytes, None
+    if not AUDIO_VAD_ENABLED:
+        return pcm, VAD_SAMPLE_RATE
+    span = await run_in_threadpool(find_speech_span, pcm)
+    if span is None:
+        return None
+    return pcm[span[0]:span[1]], VAD_SAMPLE_RATE
+
+# --- Speech-to-text backends ---
+# SPEECH_BACKEND picks the engine for uploaded utterances: "google[:<region>]" (Speech v2,
+# us-central1 by default) or "local" (an offline Vosk model on a process pool, for deployments
+# or load tests that should not depend on the network). Live streaming is Google-only.
+SPEECH_BACKEND = os.environ.get("SPEECH_BACKEND", "google")
+SPEECH_REQUEST_TIMEOUT = float(os.environ.get("SPEECH_REQUEST_TIMEOUT", "15"))
+SPEECH_MAX_CONCURRENCY = int(os.environ.get("SPEECH_MAX_CONCURRENCY", "16"))
+LOCAL_STT_MODEL_PATH = os.environ.get("LOCAL_STT_MODEL_PATH", "models/vosk-model-small-en-us")
+LOCAL_STT_WORKERS = int(os.environ.get("LOCAL_STT_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+
+try:
+    import vosk  # Optional: only needed for SPEECH_BACKEND=local.
+except ImportError:
+    vosk = None
+
+class SpeechBackend(ABC):
+    name = "base"
+    requires_pcm = False  # True if the engine cannot take the browser's WEBM/Opus blob directly.
+    supports_streaming = False
+
+    @abstractmethod
+    def available(self) -> bool:
+        ...
+
+    @abstractmethod
+    async def transcribe(self, audio: bytes, pcm_sample_rate: Optional[int], deadline: float) -> str:
+        """Returns the transcript ('' for no speech) or raises; `deadline` is a time.monotonic() value."""
+
+    def get_streaming_client(self):
+        """Blocking Speech v2 client for StreamingTranscriber, if supports_streaming."""
+        return None
+
+    def close(self):
+        pass
+
+class GoogleSpeechBackend(SpeechBackend):
+    # One shared async client per region: its gRPC channel is reused, a semaphore caps in-flight
+    # requests, and a timeout or disconnect cancels the RPC itself instead of leaving a
+    # threadpool worker blocked on it.
+    supports_streaming = True
+
+    def __init__(self, location: str = "us-central1", max_concurrency: int = SPEECH_MAX_CONCURRENCY):
+        self.location = location
+        self.name = f"google-{location}"
+        self.client = None
+        self.streaming_client = None
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def recognizer_path(self) -> str:
+        return f"projects/{PROJECT_ID}/locations/{self.location}/recognizers/_"
+
+    def available(self) -> bool:
+        return bool(speech_client_v2 and PROJECT_ID)
+
+    @property
+    def api_endpoint(self) -> str:
+        return f"{self.location}-speech.googleapis.com"
+
+    def get_client(self):
+        # Created on first use so the gRPC channel binds to the running event loop.
+        if self.client is None and PROJECT_ID:
+            self.client = SpeechAsyncClient(client_options=ClientOptions(api_endpoint=self.api_endpoint))
+        return self.client
+
+    def get_streaming_client(self) -> Optional[SpeechClient]:
+        """Blocking client for live streams; recognizers only accept requests from their own region."""
+        if self.api_endpoint == SPEECH_API_ENDPOINT:
+            return speech_client_v2
+        if self.streaming_client is None and PROJECT_ID:
+            self.streaming_client = SpeechClient(client_options=ClientOptions(api_endpoint=self.api_endpoint))
+        return self.streaming_client
+
+    async def transcribe(self, audio: bytes, pcm_sample_rate: Optional[int], deadline: float) -> str:
+        client = self.get_client()
+        if client is None:
+            raise RuntimeError("Speech client not available.")
+        request_v2 = cloud_speech.RecognizeRequest(recognizer=self.recognizer_path, config=build_recognition_config(pcm_sample_rate=pcm_sample_rate), content=audio)
+        # Time spent queueing for a slot counts against the same deadline as the call.
+        await asyncio.wait_for(self.semaphore.acquire(), timeout=max(0.1, deadline - time.monotonic()))
+        try:
+            remaining = max(0.1, deadline - time.monotonic())
+            response_v2 = await asyncio.wait_for(client.recognize(request=request_v2, timeout=remaining), timeout=remaining)
+        finally:
+            self.semaphore.release()
+        if response_v2.results and response_v2.results[0].alternatives:
+            return response_v2.results[0].alternatives[0].transcript.strip()
+        return ""
+
+_local_stt_model = None
+
+def _init_local_stt_worker(model_path: str):
+    # Runs once per pool process, so the model is loaded once and reused for every utterance.
+    global _local_stt_model
+    _local_stt_model = vosk.Model(model_path)
+
+def _transcribe_pcm_locally(pcm: bytes, sample_rate: int) -> str:
+    recognizer = vosk.KaldiRecognizer(_local_stt_model, sample_rate)
+    recognizer.AcceptWaveform(pcm)
+    return json.loads(recognizer.FinalResult()).get("text", "").strip()
+
+class LocalSpeechBackend(SpeechBackend):
+    name = "local"
+    requires_pcm = True
+
+    def __init__(self, model_path: str = LOCAL_STT_MODEL_PATH, workers: int = LOCAL_STT_WORKERS):
+        self.model_path = model_path
+        self.workers = workers
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    def available(self) -> bool:
+        return bool(vosk and FFMPEG_PATH and os.path.isdir(self.model_path))
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_local_stt_worker, initargs=(self.model_path,),
+                                            mp_context=multiprocessing.get_context(PROCESS_POOL_START_METHOD))
+        return self.pool
+
+    async def transcribe(self, audio: bytes, pcm_sample_rate: Optional[int], deadline: float) -> str:
+        future = asyncio.get_running_loop().run_in_executor(self.get_pool(), _transcribe_pcm_locally, audio, pcm_sample_rate)
+        return await asyncio.wait_for(future, timeout=max(0.1, deadline - time.monotonic()))
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+# Hedging: if the primary hasn't answered within its recent latency percentile, the same
+# utterance goes to SPEECH_HEDGE_BACKEND ("google:<region>" or "local") and the first success
+# wins. A primary that fails outright fails over to the secondary immediately.
+SPEECH_HEDGE_BACKEND = os.environ.get("SPEECH_HEDGE_BACKEND", "")
+SPEECH_HEDGE_PERCENTILE = float(os.environ.get("SPEECH_HEDGE_PERCENTILE", "0.95"))
+SPEECH_HEDGE_DEFAULT_DELAY = float(os.environ.get("SPEECH_HEDGE_DEFAULT_DELAY", "4.0"))
+SPEECH_HEDGE_MIN_DELAY = float(os.environ.get("SPEECH_HEDGE_MIN_DELAY", "0.5"))
+SPEECH_HEDGE_MIN_SAMPLES = 20
+
+class HedgedSpeechBackend(SpeechBackend):
+    def __init__(self, primary: SpeechBackend, secondary: SpeechBackend):
+        self.primary = primary
+        self.secondary = secondary
+        self.name = f"hedged({primary.name},{secondary.name})"
+        self.requires_pcm = primary.requires_pcm or secondary.requires_pcm
+        self.supports_streaming = primary.supports_streaming
+        self.primary_latencies: deque = deque(maxlen=200)
+
+    @property
+    def recognizer_path(self) -> str:
+        return self.primary.recognizer_path
+
+    def get_streaming_client(self):
+        return self.primary.get_streaming_client()
+
+    def available(self) -> bool:
+        return self.primary.available() or self.secondary.available()
+
+    def hedge_delay(self) -> float:
+        if len(self.primary_latencies) < SPEECH_HEDGE_MIN_SAMPLES:
+            return SPEECH_HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.primary_latencies)
+        return max(SPEECH_HEDGE_MIN_DELAY, ordered[int(SPEECH_HEDGE_PERCENTILE * (len(ordered) - 1))])
+
+    async def _timed_primary(self, audio, pcm_sample_rate, deadline):
+        started = time.monotonic()
+        try:
+            text = await self.primary.transcribe(audio, pcm_sample_rate, deadline)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # A primary that was hedged away or timed out took at least this long. Leaving it
+            # out would censor the sample at the current delay and drag the percentile down.
+            self.primary_latencies.append(time.monotonic() - started)
+            raise
+        self.primary_latencies.append(time.monotonic() - started)
+        return text
+
+    async def transcribe(self, audio: bytes, pcm_sample_rate: Optional[int], deadline: float) -> str:
+        if not self.primary.available():
+            return await self.secondary.transcribe(audio, pcm_sample_rate, deadline)
+        primary_task = asyncio.create_task(self._timed_primary(audio, pcm_sample_rate, deadline))
+        pending = {primary_task}
+        try:
+            hedge_after = min(self.hedge_delay(), max(0.0, deadline - time.monotonic()))
+            done, _ = await asyncio.wait({primary_task}, timeout=hedge_after)
+            if primary_task in done and primary_task.exception() is None:
+                return primary_task.result()
+            if not self.secondary.available():
+                return await primary_task
+
+            print(f"Speech hedge: primary {'failed' if done else 'slow'}, sending to {self.secondary.name}.")
+            if done:
+                pending = set()
+            pending.add(asyncio.create_task(self.secondary.transcribe(audio, pcm_sample_rate, deadline)))
+            last_error = primary_task.exception() if done else None
+            while pending:
+                finished, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                if not finished:
+                    raise asyncio.TimeoutError()
+                for task in finished:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def close(self):
+        self.primary.close()
+        self.secondary.close()
+
+def create_speech_backend(spec: str) -> SpeechBackend:
+    kind, _, location = spec.partition(":")
+    if kind == "local":
+        return LocalSpeechBackend()
+    return GoogleSpeechBackend(location or "us-central1")
+
+speech_backend: SpeechBackend = create_speech_backend(SPEECH_BACKEND)
+if SPEECH_HEDGE_BACKEND:
+    speech_backend = HedgedSpeechBackend(speech_backend, create_speech_backend(SPEECH_HEDGE_BACKEND))
+if not speech_backend.available():
+    print(f"ERROR: Speech backend '{speech_backend.name}' is not available.")
+
+# Clients resend the same blob after reconnects and retries; identical audio under the same
+# recognition settings gets the cached transcript back. Failures are never cached.
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get("TRANSCRIPT_CACHE_SIZE", "512"))
+transcript_cache = LRUCache(maxsize=TRANSCRIPT_CACHE_SIZE)
+transcript_cache_stats = {"hits": 0, "misses": 0}
+
+def transcript_cache_key(audio_bytes: bytes) -> str:
+    config_key = f"{speech_backend.name}|{SPEECH_MODEL}|en-US|vad={AUDIO_VAD_ENABLED}"
+    return hashlib.sha256(audio_bytes).hexdigest() + ":" + hashlib.sha256(config_key.encode()).hexdigest()[:16]
+
+async def recognize_utterance(audio_bytes: bytes, timeout: float = SPEECH_REQUEST_TIMEOUT) -> str:
+    """Transcribes one complete utterance; failures come back as bracketed placeholder text."""
+    cache_key = transcript_cache_key(audio_bytes)
+    cached_text = transcript_cache.get(cache_key)
+    if cached_text is not None:
+        transcript_cache_stats["hits"] += 1
+        return cached_text
+    transcript_cache_stats["misses"] += 1
+
+    deadline = time.monotonic() + timeout
+    try:
+        prepared = await prepare_utterance_audio(audio_bytes, require_pcm=speech_backend.requires_pcm)
+        if prepared is None:
+            transcript_cache[cache_key] = "[No speech detected]"
+            return "[No speech detected]"
+        audio_content, pcm_sample_rate = prepared
+        transcribed_text = await speech_backend.transcribe(audio_content, pcm_sample_rate, deadline)
+    except (asyncio.TimeoutError, google_exceptions.DeadlineExceeded):
+        print(f"ERROR: Speech-to-text ({speech_backend.name}) call timed out.")
+        return "[Transcription timed out due to a network issue on the server.]"
+    except Exception as e:
+        print(f"ERROR: Speech-to-text ({speech_backend.name}) failed! Details: {e}")
+        return "[Transcription failed on server. Please try again.]"
+    transcribed_text = transcribed_text or "[No speech detected]"
+    transcript_cache[cache_key] = transcribed_text
+    return transcribed_text
+
+# Each connection transcribes uploaded utterances on its own worker task, one at a time and
+# in arrival order, so the receive loop keeps handling control messages meanwhile.
+AUDIO_QUEUE_MAX_PENDING = int(os.environ.get("AUDIO_QUEUE_MAX_PENDING", "3"))
+# "reject": refuse the new utterance and tell the client; "drop_oldest": discard the stalest pending one.
+AUDIO_QUEUE_FULL_POLICY = os.environ.get("AUDIO_QUEUE_FULL_POLICY", "reject")
+
+class TranscriptionPipeline:
+    def __init__(self, websocket: WebSocket, max_pending: int = AUDIO_QUEUE_MAX_PENDING, full_policy: str = AUDIO_QUEUE_FULL_POLICY):
+        self.websocket = websocket
+        self.full_policy = full_policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_pending))
+        self.worker = asyncio.create_task(self._work())
+
+    async def submit(self, audio_bytes: bytes):
+        if self.queue.full():
+            if self.full_policy == "drop_oldest":
+                self.queue.get_nowait()
+                self.queue.task_done()
+                print("Audio queue full: dropped the oldest pending utterance.")
+            else:
+                print("Audio queue full: rejected a new utterance.")
+                await self.websocket.send_json({"type": "error", "text": "Still transcribing your previous answer. Please try again in a moment."})
+                return
+        self.queue.put_nowait(audio_bytes)
+
+    async def _work(self):
+        while True:
+            audio_bytes = await self.queue.get()
+            try:
+                transcribed_text = await recognize_utterance(audio_bytes)
+                await self.websocket.send_json({"type": "user_interim_transcript", "text": transcribed_text})
+            except Exception as e:
+                print(f"Transcription worker error: {e}")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        self.worker.cancel()  # Also cancels an in-flight recognize call.
+
+class StreamingTranscriber:
+    """
+    Forwards live audio frames to the Speech v2 streaming API and relays results to the client:
+    `user_live_transcript` updates while the founder talks, then the usual `user_interim_transcript`
+    (is_final True) when the speech service detects the end of speech or the client ends the stream.
+    Frames that arrive after the service has ended the stream are the tail of the same recording
+    and cannot be decoded on their own; they are counted and discarded. Nothing here blocks the
+    caller: close() ends the audio and the final transcript is sent once it arrives, or after
+    STREAMING_SPEECH_FINISH_TIMEOUT with whatever was recognized so far.
+    """
+    active = 0  # Streams holding or queued for a streaming_speech_executor thread.
+
+    @classmethod
+    def at_capacity(cls) -> bool:
+        return cls.active >= STREAMING_SPEECH_MAX_STREAMS
+
+    def __init__(self, websocket: WebSocket, recognizer_path: str, client: SpeechClient):
+        self.websocket = websocket
+        self.recognizer_path = recognizer_path
+        self.client = client
+        self.audio_queue: queue.Queue = queue.Queue()
+        self.results: asyncio.Queue = asyncio.Queue()
+        self.final_parts: List[str] = []
+        self.closed = False
+        self.abandoned = False
+        self.discarded_bytes = 0
+        self.loop = asyncio.get_running_loop()
+        StreamingTranscriber.active += 1
+        self.stream_future = self.loop.run_in_executor(streaming_speech_executor, self._run_stream)
+        self.stream_future.add_done_callback(self._on_stream_done)
+        self.relay_task = asyncio.create_task(self._relay_results())
+
+    @staticmethod
+    def _on_stream_done(_future):
+        StreamingTranscriber.active -= 1
+
+    def _requests(self):
+        streaming_features = cloud_speech.StreamingRecognitionFeatures(
+            interim_results=True,
+            enable_voice_activity_events=True,
+            voice_activity_timeout=cloud_speech.StreamingRecognitionFeatures.VoiceActivityTimeout(
+                speech_end_timeout=duration_pb2.Duration(seconds=int(STREAMING_SPEECH_END_TIMEOUT), nanos=int(STREAMING_SPEECH_END_TIMEOUT % 1 * 1e9))
+            ),
+        )
+        streaming_config = cloud_speech.StreamingRecognitionConfig(config=build_recognition_config(STREAMING_SPEECH_MODEL), streaming_features=streaming_features)
+        yield cloud_speech.StreamingRecognizeRequest(recognizer=self.recognizer_path, streaming_config=streaming_config)
+        while (chunk := self.audio_queue.get()) is not None:
+            yield cloud_speech.StreamingRecognizeRequest(audio=chunk)
+
+    def _run_stream(self):
+        # Runs on a streaming thread; every event is handed back to the event loop.
+        if self.abandoned:
+            return  # Gave up while queued for a thread; the transcript has already been sent.
+        push = lambda event: self.loop.call_soon_threadsafe(self.results.put_nowait, event)
+        try:
+            for response in self.client.streaming_recognize(requests=self._requests()):
+                if response.speech_event_type == cloud_speech.StreamingRecognizeResponse.SpeechEventType.SPEECH_ACTIVITY_END:
+                    push(("endpoint", None))
+                for result in response.results:
+                    if result.alternatives:
+                        push(("final" if result.is_final else "interim", result.alternatives[0].transcript))
+        except Exception as e:
+            push(("error", str(e)))
+        finally:
+            push(("done", None))
+
+    async def _relay_results(self):
+        interim_text = ""
+        while True:
+            kind, text = await self.results.get()
+            if kind == "interim":
+                interim_text = text.strip()
+                await self._send(" ".join(self.final_parts + [interim_text]), is_final=False)
+            elif kind == "final":
+                interim_text = ""
+                if text.strip():
+                    self.final_parts.append(text.strip())
+                    await self._send(" ".join(self.final_parts), is_final=False)
+            elif kind == "endpoint":
+                self.close()  # The speech service heard the founder stop; stop sending audio.
+            elif kind == "error":
+                print(f"ERROR: Streaming speech recognition failed! Details: {text}")
+                if not self.final_parts:
+                    self.final_parts.append("[Transcription failed on server. Please try again.]")
+            elif kind == "done":
+                final_text = " ".join(self.final_parts) or interim_text or "[No speech detected]"
+                await self._send(final_text, is_final=True)
+                if self.discarded_bytes:
+                    print(f"Streaming transcription: discarded {self.discarded_bytes} bytes received after the end of speech.")
+                return
+
+    async def _send(self, text: str, is_final: bool):
+        # Clients that predate live mode treat any user_interim_transcript as the final one.
+        frame_type = "user_interim_transcript" if is_final else "user_live_transcript"
+        try:
+            await self.websocket.send_json({"type": frame_type, "text": text, "is_final": is_final})
+        except Exception as e:
+            print(f"Could not send streaming transcript: {e}")
+
+    def feed(self, audio_bytes: bytes):
+        if self.closed:
+            self.discarded_bytes += len(audio_bytes)
+            return
+        for start in range(0, len(audio_bytes), STREAMING_AUDIO_CHUNK_BYTES):
+            self.audio_queue.put(audio_bytes[start:start + STREAMING_AUDIO_CHUNK_BYTES])
+
+    def close(self):
+        """Ends the audio stream; the final transcript follows without the caller waiting for it."""
+        if not self.closed:
+            self.closed = True
+            self.audio_queue.put(None)
+            self.loop.call_later(STREAMING_SPEECH_FINISH_TIMEOUT, self._give_up)
+
+    def _give_up(self):
+        if not self.relay_task.done():
+            self.abandoned = True
+            self.results.put_nowait(("error", "no final result before STREAMING_SPEECH_FINISH_TIMEOUT"))
+            self.results.put_nowait(("done", None))
+
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    await report_jobs.stop()
+    speech_backend.close()
+    deck_processing.close()
+    deck_analysis_cache.stop()
+
+
 # --- API ENDPOINTS ---
 async def verify_id_token(token: str):
     if not token: return None
@@ -630,6 +2539,11 @@ async def get_current_user_uid(authorization: str = Header(None)):
     if not uid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
     return uid
+
+async def get_optional_user_uid(authorization: str = Header(None)) -> Optional[str]:
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    return await verify_id_token(authorization.split(" ")[1])
     
 @app.get('/login/google')
 async def login_via_google(request: Request):
@@ -676,20 +2590,683 @@ async def auth_via_google(request: Request):
     
     return RedirectResponse(url=f"{frontend_url}/?error=unknown")
 
-@app.post("/upload-audio/{session_id}")
-async def upload_audio(session_id: str, file: UploadFile = File(...)):
+# --- Replay storage ---
+# AUDIO_REPLAY_DIR is a size-bounded LRU cache in front of a blob store (REPLAY_STORAGE):
+# "gs://bucket/prefix" for GCS, "file:///path" for a local stand-in, or "local" to keep replays
+# on this disk only (never evicted, so only REPLAY_RETENTION_DAYS bounds it). New replays are
+# served from the cache straight away and uploaded in the background; cold replays are
+# downloaded on first play.
+REPLAY_STORAGE = os.environ.get("REPLAY_STORAGE", "local")
+REPLAY_CACHE_MAX_BYTES = int(os.environ.get("REPLAY_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+REPLAY_RETENTION_DAYS = int(os.environ.get("REPLAY_RETENTION_DAYS", "90"))  # 0 keeps replays forever.
+REPLAY_SWEEP_INTERVAL_SECONDS = int(os.environ.get("REPLAY_SWEEP_INTERVAL_SECONDS", str(6 * 3600)))
+REPLAY_STALE_PART_SECONDS = 24 * 3600  # Abandoned resumable uploads are dropped after a day.
+REPLAY_UPLOAD_MAX_ATTEMPTS = 5
+
+try:
+    from google.cloud import storage as gcs  # Optional: only needed for REPLAY_STORAGE=gs://...
+except ImportError:
+    gcs = None
+
+class ReplayBlobStore(ABC):
+    """Durable replay storage. Methods block and are called from the threadpool."""
+    name = "blob"
+
+    @abstractmethod
+    def upload(self, key: str, path: str):
+        ...
+
+    @abstractmethod
+    def download(self, key: str, path: str) -> bool:
+        """Copies the blob to path; False if it does not exist."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def list_older_than(self, cutoff: float) -> List[str]:
+        ...
+
+class GCSReplayStore(ReplayBlobStore):
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.name = f"gs://{bucket}/{prefix}"
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.bucket = gcs.Client().bucket(bucket)
+
+    def upload(self, key: str, path: str):
+        self.bucket.blob(self.prefix + key).upload_from_filename(path)
+
+    def download(self, key: str, path: str) -> bool:
+        try:
+            self.bucket.blob(self.prefix + key).download_to_filename(path)
+            return True
+        except google_exceptions.NotFound:
+            return False
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(self.prefix + key).exists()
+
+    def delete(self, key: str):
+        try:
+            self.bucket.blob(self.prefix + key).delete()
+        except google_exceptions.NotFound:
+            pass
+
+    def list_older_than(self, cutoff: float) -> List[str]:
+        return [blob.name[len(self.prefix):] for blob in self.bucket.list_blobs(prefix=self.prefix)
+                if blob.updated and blob.updated.timestamp() < cutoff]
+
+class FileSystemReplayStore(ReplayBlobStore):
+    """Blob store on a local directory, e.g. a mounted volume or a test fixture."""
+    def __init__(self, root: str):
+        self.name = f"file://{root}"
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def upload(self, key: str, path: str):
+        tmp_path = os.path.join(self.root, f".{key}.{uuid.uuid4().hex}")
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, os.path.join(self.root, key))
+
+    def download(self, key: str, path: str) -> bool:
+        try:
+            shutil.copyfile(os.path.join(self.root, key), path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.root, key))
+
+    def delete(self, key: str):
+        _remove_quietly(os.path.join(self.root, key))
+
+    def list_older_than(self, cutoff: float) -> List[str]:
+        return [entry.name for entry in os.scandir(self.root)
+                if entry.is_file() and not entry.name.startswith(".") and entry.stat().st_mtime < cutoff]
+
+def create_replay_store(spec: str) -> Optional[ReplayBlobStore]:
+    if spec.startswith("gs://"):
+        if gcs is None:
+            print("ERROR: google-cloud-storage is not installed; keeping replays on local disk only.")
+            return None
+        bucket, _, prefix = spec[len("gs://"):].partition("/")
+        return GCSReplayStore(bucket, prefix)
+    if spec.startswith("file://"):
+        return FileSystemReplayStore(spec[len("file://"):])
+    return None
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class ReplayStorage:
+    """
+    Local LRU cache of replay files (and their owner sidecars) backed by an optional blob store.
+    Only replays already uploaded to the store are evicted, so a replay is never lost to eviction.
+    """
+    def __init__(self, cache_dir: str, store: Optional[ReplayBlobStore], max_cache_bytes: int = REPLAY_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.store = store
+        self.max_cache_bytes = max_cache_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # Replay file name -> bytes, LRU first.
+        self.pending_uploads: Dict[str, asyncio.Task] = {}
+        self.fetch_locks: Dict[str, asyncio.Lock] = {}
+        self.sweeper: Optional[asyncio.Task] = None
+
+    def _local_files(self, name: str) -> List[str]:
+        return [os.path.join(self.cache_dir, name), os.path.join(self.cache_dir, name + ".owner.json")]
+
+    def _scan_cache(self) -> List[tuple]:
+        replays = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".webm"):
+                stat_result = entry.stat()
+                replays.append((stat_result.st_atime, entry.name, stat_result.st_size))
+        return sorted(replays)
+
+    async def start(self):
+        # Startup scans the local directory: bounded by the cache size with a store, and only by
+        # the retention window without one.
+        if not self.store and REPLAY_RETENTION_DAYS <= 0:
+            print("WARNING: REPLAY_STORAGE=local with REPLAY_RETENTION_DAYS=0 keeps every replay on this disk; "
+                  "disk usage and startup time grow with every recorded session.")
+        for _, name, size in await run_in_threadpool(self._scan_cache):
+            self.entries[name] = size
+        if self.store:
+            for name in list(self.entries):
+                self._schedule_upload(name, only_if_missing=True)
+        self.sweeper = asyncio.create_task(self._sweep_loop())
+        print(f"Replay storage: {len(self.entries)} cached replays, store={self.store.name if self.store else 'local disk only'}.")
+
+    async def stop(self, timeout: float = 30.0):
+        if self.sweeper:
+            self.sweeper.cancel()
+        # Give in-flight uploads a chance to finish; on redeploy the local disk is gone.
+        if self.pending_uploads:
+            await asyncio.wait(list(self.pending_uploads.values()), timeout=timeout)
+
+    async def add(self, name: str):
+        """Registers a freshly written replay and uploads it in the background."""
+        self.entries[name] = os.path.getsize(os.path.join(self.cache_dir, name))
+        self.entries.move_to_end(name)
+        if self.store:
+            self._schedule_upload(name)
+        await self._evict()
+
+    async def fetch(self, name: str) -> Optional[str]:
+        """Returns a local path for the replay, downloading it from the store on a cache miss."""
+        path = os.path.join(self.cache_dir, name)
+        if os.path.exists(path):
+            self.entries.setdefault(name, os.path.getsize(path))
+            self.entries.move_to_end(name)
+            return path
+        if not self.store:
+            return None
+        lock = self.fetch_locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name not in self.entries:
+                if not await run_in_threadpool(self._download, name):
+                    self.fetch_locks.pop(name, None)
+                    return None
+                self.entries[name] = os.path.getsize(path)
+        self.fetch_locks.pop(name, None)
+        self.entries.move_to_end(name)
+        await self._evict(keep=name)
+        return path
+
+    def _download(self, name: str) -> bool:
+        video_path, owner_path = self._local_files(name)
+        if not os.path.exists(owner_path):
+            self._download_key(name + ".owner.json", owner_path)
+        return self._download_key(name, video_path)
+
+    def _download_key(self, key: str, path: str) -> bool:
+        tmp_path = f"{path}.{uuid.uuid4().hex}.download"
+        try:
+            if not self.store.download(key, tmp_path):
+                _remove_quietly(tmp_path)
+                return False
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            _remove_quietly(tmp_path)
+            print(f"Error downloading replay {key} from {self.store.name}: {e}")
+            return False
+
+    async def owner(self, name: str) -> Optional[str]:
+        """The recorded owner of a replay, reading only the small sidecar from the store if needed."""
+        owner_path = self._local_files(name)[1]
+        if not os.path.exists(owner_path) and self.store:
+            await run_in_threadpool(self._download_key, name + ".owner.json", owner_path)
+        try:
+            with open(owner_path) as f:
+                return json.load(f).get("user_uid")
+        except (OSError, ValueError):
+            return None
+
+    async def exists(self, name: str) -> bool:
+        if os.path.exists(os.path.join(self.cache_dir, name)):
+            return True
+        return bool(self.store) and await run_in_threadpool(self.store.exists, name)
+
+    def _schedule_upload(self, name: str, only_if_missing: bool = False):
+        if name not in self.pending_uploads:
+            self.pending_uploads[name] = asyncio.create_task(self._upload(name, only_if_missing))
+
+    async def _upload(self, name: str, only_if_missing: bool):
+        try:
+            for attempt in range(1, REPLAY_UPLOAD_MAX_ATTEMPTS + 1):
+                try:
+                    await run_in_threadpool(self._upload_files, name, only_if_missing)
+                    return
+                except Exception as e:
+                    print(f"Replay upload {name} failed (attempt {attempt}/{REPLAY_UPLOAD_MAX_ATTEMPTS}): {e}")
+                    await asyncio.sleep(min(60, 2 ** attempt))
+        finally:
+            self.pending_uploads.pop(name, None)
+        await self._evict()
+
+    def _upload_files(self, name: str, only_if_missing: bool):
+        if only_if_missing and self.store.exists(name):
+            return
+        video_path, owner_path = self._local_files(name)
+        if os.path.exists(owner_path):
+            self.store.upload(name + ".owner.json", owner_path)
+        # The replay itself goes last so that its presence means the upload is complete.
+        self.store.upload(name, video_path)
+
+    async def _evict(self, keep: Optional[str] = None):
+        if not self.store:
+            return  # Without a blob store the local copy is the only one.
+        total = sum(self.entries.values())
+        for name in list(self.entries):
+            if total <= self.max_cache_bytes:
+                break
+            if name == keep or name in self.pending_uploads:
+                continue
+            total -= self.entries.pop(name)
+            for path in self._local_files(name):
+                _remove_quietly(path)
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Replay retention sweep failed: {e}")
+            await asyncio.sleep(REPLAY_SWEEP_INTERVAL_SECONDS)
+
+    async def sweep(self):
+        """Applies the retention policy and clears out abandoned partial uploads."""
+        now = time.time()
+        # Owner sidecars without a cached replay are left by lookups against the store or by
+        # replays removed out of band; the store keeps its own copy of the former.
+        stale_parts = [entry.path for entry in os.scandir(self.cache_dir)
+                       if (entry.name.endswith((".part", ".download"))
+                           or entry.name.endswith(".owner.json") and entry.name.removesuffix(".owner.json") not in self.entries)
+                       and entry.stat().st_mtime < now - REPLAY_STALE_PART_SECONDS]
+        for path in stale_parts:
+            _remove_quietly(path)
+        if REPLAY_RETENTION_DAYS <= 0:
+            return
+        cutoff = now - REPLAY_RETENTION_DAYS * 86400
+        expired = [name for name in self.entries if os.path.getmtime(os.path.join(self.cache_dir, name)) < cutoff]
+        if self.store:
+            expired_keys = await run_in_threadpool(self.store.list_older_than, cutoff)
+            for key in expired_keys:
+                await run_in_threadpool(self.store.delete, key)
+                if key.endswith(".webm"):
+                    await run_in_threadpool(self.store.delete, key + ".owner.json")
+            expired += [key for key in expired_keys if key.endswith(".webm")]
+        for name in set(expired):
+            if name in self.pending_uploads:
+                continue
+            self.entries.pop(name, None)
+            for path in self._local_files(name):
+                _remove_quietly(path)
+        if expired:
+            print(f"Replay retention: removed {len(set(expired))} replays older than {REPLAY_RETENTION_DAYS} days.")
+
+replay_storage = ReplayStorage(AUDIO_REPLAY_DIR, create_replay_store(REPLAY_STORAGE))
+
+@app.on_event("startup")
+async def start_replay_storage():
+    await replay_storage.start()
+
+@app.on_event("shutdown")
+async def stop_replay_storage():
+    await replay_storage.stop()
+
+
+# --- Session replay uploads ---
+# Recordings are streamed to a temp file in chunks and atomically renamed into place, so memory
+# use does not grow with recording length and a failed upload never leaves a truncated replay.
+# Long sessions can also be sent in resumable chunks (Content-Range) via /resumable.
+# Multipart uploads are parsed as the body streams in rather than spooled by the form parser,
+# so oversized or non-WEBM uploads are refused before the whole body has been received.
+REPLAY_MAX_BYTES = int(os.environ.get("REPLAY_MAX_BYTES", str(200 * 1024 * 1024)))
+REPLAY_UPLOAD_CHUNK_BYTES = 1024 * 1024
+REPLAY_MULTIPART_OVERHEAD_BYTES = 64 * 1024  # Boundaries and part headers around the file.
+WEBM_MAGIC = b"\x1a\x45\xdf\xa3"  # EBML header that starts every WEBM file.
+REPLAY_CONTENT_TYPES = {"audio/webm", "video/webm", "application/octet-stream"}
+replay_upload_locks: Dict[str, asyncio.Lock] = {}
+
+def safe_replay_id(session_id: str) -> str:
     safe_session_id = "".join(c for c in session_id if c.isalnum() or c in ('_','-')).rstrip()
     if not safe_session_id:
-        return {"error": "Invalid session ID"}, 400
-    file_path = os.path.join(AUDIO_REPLAY_DIR, f"{safe_session_id}.webm")
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+    return safe_session_id
+
+def replay_path(safe_session_id: str) -> str:
+    return os.path.join(AUDIO_REPLAY_DIR, f"{safe_session_id}.webm")
+
+async def write_replay_chunks(chunks, part_path: str, mode: str, start_size: int, limit: int) -> int:
+    """Appends chunks to part_path, enforcing the WEBM header and a size limit. Returns the new size."""
+    size = start_size
+    async with aiofiles.open(part_path, mode) as out:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if size == 0 and len(chunk) >= len(WEBM_MAGIC) and not chunk.startswith(WEBM_MAGIC):
+                raise HTTPException(status_code=415, detail="Replay must be a WEBM recording.")
+            size += len(chunk)
+            if size > limit:
+                raise HTTPException(status_code=413, detail=f"Replay exceeds the {REPLAY_MAX_BYTES // (1024 * 1024)} MB limit.")
+            await out.write(chunk)
+    return size
+
+class MultipartFileStream:
+    """Yields the bytes of one file field of a multipart/form-data request as the body arrives."""
+    def __init__(self, request: Request, field_name: str):
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload.")
+        self.request = request
+        self.field_name = field_name.encode()
+        self.content_type: Optional[str] = None  # Of the file part, once its headers are parsed.
+        self.found = False
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._in_file = False
+        self._data: List[bytes] = []
+        self.parser = MultipartParser(params[b"boundary"], callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._in_file = not self.found and options.get(b"name") == self.field_name
+        if self._in_file:
+            self.found = True
+            self.content_type = self._headers.get(b"content-type", b"").decode("latin-1")
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        self._in_file = False
+
+    async def chunks(self):
+        async for body_chunk in self.request.stream():
+            self.parser.write(body_chunk)
+            data, self._data = self._data, []
+            for chunk in data:
+                yield chunk
+        self.parser.finalize()
+        if not self.found:
+            raise HTTPException(status_code=400, detail=f"Missing '{self.field_name.decode()}' file field.")
+
+def replay_owner_path(final_path: str) -> str:
+    return final_path + ".owner.json"
+
+def session_belongs_to(safe_session_id: str, user_uid: str) -> bool:
+    """True if user_uid has a saved Firestore session with this ID."""
+    if not fb_db:
+        return True  # Local development without Firestore has no owners to check against.
+    try:
+        return fb_db.collection('users').document(user_uid).collection('sessions').document(safe_session_id).get().exists
+    except Exception as e:
+        print(f"Error checking owner of session {safe_session_id}: {e}")
+        return False
+
+def session_in_progress_for(safe_session_id: str, user_uid: str) -> bool:
+    """True if user_uid has this session open on a WebSocket or awaiting its report job."""
+    # Raw IDs look like "session_<timestamp>"; uploads only ever see their sanitized form.
+    matches = lambda session_id: bool(session_id) and safe_replay_id(session_id) == safe_session_id
+    if any(conn_data.get("user_uid") == user_uid and matches(conn_data.get("current_session_id"))
+           for conn_data in manager.active_connections.values()):
+        return True
+    return any(job["user_uid"] == user_uid and matches(job["session_id"]) for job in report_jobs.jobs.values())
+
+def _create_owner_file(owner_path: str, user_uid: str) -> str:
+    """Records user_uid as owner unless someone already is; returns whoever owns it now."""
+    try:
+        fd = os.open(owner_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with open(owner_path) as f:
+            return json.load(f).get("user_uid")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"user_uid": user_uid}, f)
+    return user_uid
+
+async def claim_replay(safe_session_id: str, user_uid: str):
+    """
+    Raises 403 unless user_uid may write this session's replay: its recorded owner, or, while it
+    has none, the user whose session it is (open on a WebSocket, awaiting its report, or saved
+    in Firestore). Session IDs are chosen by the client, so being first is not enough.
+    """
+    owner = await replay_storage.owner(f"{safe_session_id}.webm")
+    if owner is not None:
+        allowed = owner == user_uid
+    else:
+        allowed = session_in_progress_for(safe_session_id, user_uid) or await run_in_threadpool(session_belongs_to, safe_session_id, user_uid)
+    if not allowed:
+        raise HTTPException(status_code=403, detail="This replay belongs to another user.")
+
+async def finalize_replay(part_path: str, final_path: str, safe_session_id: str, user_uid: str):
+    """Moves a validated upload into place; the owner is recorded only once the replay exists."""
+    async with aiofiles.open(part_path, "rb") as f:
+        if await f.read(len(WEBM_MAGIC)) != WEBM_MAGIC:
+            raise HTTPException(status_code=415, detail="Replay must be a WEBM recording.")
+    await claim_replay(safe_session_id, user_uid)  # Re-checked: another upload may have landed meanwhile.
+    os.replace(part_path, final_path)
+    owner = await run_in_threadpool(_create_owner_file, replay_owner_path(final_path), user_uid)
+    if owner != user_uid:
+        print(f"Replay {safe_session_id} was replaced by {user_uid} but is owned by {owner}.")
+    await replay_storage.add(os.path.basename(final_path))
+
+@app.post("/upload-audio/{session_id}")
+async def upload_audio(session_id: str, request: Request, user_uid: str = Depends(get_current_user_uid)):
+    """Takes the replay as the `file` field of a multipart/form-data body."""
+    safe_session_id = safe_replay_id(session_id)
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > REPLAY_MAX_BYTES + REPLAY_MULTIPART_OVERHEAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Replay exceeds the {REPLAY_MAX_BYTES // (1024 * 1024)} MB limit.")
+    upload = MultipartFileStream(request, "file")
+    await claim_replay(safe_session_id, user_uid)
+    final_path = replay_path(safe_session_id)
+    part_path = f"{final_path}.{uuid.uuid4().hex}.part"
+
+    async def upload_chunks():
+        checked = False
+        async for chunk in upload.chunks():
+            if not checked:
+                content_type = (upload.content_type or "").split(";")[0].strip().lower()
+                if content_type and content_type not in REPLAY_CONTENT_TYPES:
+                    raise HTTPException(status_code=415, detail="Replay must be a WEBM recording.")
+                checked = True
+            yield chunk
+
     try:
-        async with aiofiles.open(file_path, "wb") as buffer:
-            content = await file.read()
-            await buffer.write(content)
+        await write_replay_chunks(upload_chunks(), part_path, "wb", 0, REPLAY_MAX_BYTES)
+        async with replay_upload_locks.setdefault(safe_session_id, asyncio.Lock()):
+            try:
+                await finalize_replay(part_path, final_path, safe_session_id, user_uid)
+            finally:
+                replay_upload_locks.pop(safe_session_id, None)
+    except HTTPException:
+        _remove_quietly(part_path)
+        raise
     except Exception as e:
-        return {"error": f"Failed to save file: {e}"}, 500
+        _remove_quietly(part_path)
+        raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
     return {"status": "success", "path": f"/replays/{safe_session_id}.webm"}
 
+@app.get("/upload-audio/{session_id}/resumable")
+async def get_resumable_upload_offset(session_id: str, user_uid: str = Depends(get_current_user_uid)):
+    safe_session_id = safe_replay_id(session_id)
+    await claim_replay(safe_session_id, user_uid)
+    part_path = replay_path(safe_session_id) + ".part"
+    return {"offset": os.path.getsize(part_path) if os.path.exists(part_path) else 0}
+
+@app.put("/upload-audio/{session_id}/resumable")
+async def upload_audio_chunk(session_id: str, request: Request, content_range: str = Header(...), user_uid: str = Depends(get_current_user_uid)):
+    """
+    Accepts one chunk with `Content-Range: bytes <start>-<end>/<total>`. Chunks must arrive in
+    order; a mismatched start gets 409 with the offset to resume from. The replay is moved into
+    place once <total> bytes have been received.
+    """
+    safe_session_id = safe_replay_id(session_id)
+    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+)", content_range.strip())
+    if not match:
+        raise HTTPException(status_code=400, detail="Content-Range must look like 'bytes <start>-<end>/<total>'.")
+    start, end, total = (int(value) for value in match.groups())
+    if end < start or end >= total:
+        raise HTTPException(status_code=400, detail="Invalid Content-Range.")
+    if total > REPLAY_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Replay exceeds the {REPLAY_MAX_BYTES // (1024 * 1024)} MB limit.")
+
+    await claim_replay(safe_session_id, user_uid)
+    final_path = replay_path(safe_session_id)
+    part_path = final_path + ".part"
+    lock = replay_upload_locks.setdefault(safe_session_id, asyncio.Lock())
+    async with lock:
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if start != offset:
+            raise HTTPException(status_code=409, detail={"message": "Unexpected chunk offset.", "offset": offset})
+        try:
+            new_size = await write_replay_chunks(request.stream(), part_path, "ab", offset, end + 1)
+        except HTTPException:
+            # Roll back the partial chunk so the client can resend it from the same offset.
+            os.truncate(part_path, offset)
+            raise
+        if new_size != end + 1:
+            os.truncate(part_path, offset)
+            raise HTTPException(status_code=400, detail="Chunk length does not match Content-Range.")
+        if new_size < total:
+            return {"status": "incomplete", "offset": new_size}
+        try:
+            await finalize_replay(part_path, final_path, safe_session_id, user_uid)
+        except HTTPException:
+            _remove_quietly(part_path)
+            raise
+        finally:
+            replay_upload_locks.pop(safe_session_id, None)
+    return {"status": "success", "path": f"/replays/{safe_session_id}.webm"}
+
+
+# --- Session replay playback ---
+class ReplayFileResponse(FileResponse):
+    """
+    FileResponse that hands the file descriptor to the server via the ASGI zero-copy extension
+    (sendfile) when the server offers it, instead of reading it through Python in 64 KB chunks.
+    """
+    async def _handle_simple(self, send, send_header_only: bool) -> None:
+        if send_header_only or not self.zerocopy:
+            return await super()._handle_simple(send, send_header_only)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await self._send_zerocopy(send, 0, self.stat_result.st_size)
+
+    async def _handle_single_range(self, send, start: int, end: int, file_size: int, send_header_only: bool) -> None:
+        if send_header_only or not self.zerocopy:
+            return await super()._handle_single_range(send, start, end, file_size, send_header_only)
+        self.headers["content-range"] = f"bytes {start}-{end - 1}/{file_size}"
+        self.headers["content-length"] = str(end - start)
+        await send({"type": "http.response.start", "status": 206, "headers": self.raw_headers})
+        await self._send_zerocopy(send, start, end - start)
+
+    async def _send_zerocopy(self, send, offset: int, count: int):
+        with open(self.path, "rb") as file:
+            await send({"type": "http.response.zerocopy", "file": file, "offset": offset, "count": count, "more_body": False})
+
+    async def __call__(self, scope, receive, send) -> None:
+        self.zerocopy = "http.response.zerocopy" in scope.get("extensions", {})
+        await super().__call__(scope, receive, send)
+
+# <audio src> cannot set headers. Instead of putting the ID token in the URL (and so in access
+# logs), the client asks /replays/{filename}/link for a short-lived link signed for its user.
+REPLAY_LINK_SECRET = os.environ.get("REPLAY_LINK_SECRET", os.environ.get('SESSION_SECRET_KEY', 'a_default_secret_key_for_dev'))
+REPLAY_LINK_TTL_SECONDS = int(os.environ.get("REPLAY_LINK_TTL_SECONDS", "3600"))
+
+def sign_replay_link(filename: str, user_uid: str, expires: int) -> str:
+    message = f"{filename}|{user_uid}|{expires}".encode()
+    return hmac.new(REPLAY_LINK_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+async def get_replay_viewer_uid(filename: str, authorization: str = Header(None), uid: Optional[str] = None,
+                                expires: Optional[int] = None, sig: Optional[str] = None) -> str:
+    if authorization and authorization.startswith("Bearer "):
+        viewer_uid = await verify_id_token(authorization.split(" ")[1])
+    elif uid and expires and sig and expires > time.time():
+        viewer_uid = uid if hmac.compare_digest(sig, sign_replay_link(filename, uid, expires)) else None
+    else:
+        viewer_uid = None
+    if not viewer_uid:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+    return viewer_uid
+
+async def replay_visible_to(safe_session_id: str, user_uid: str) -> bool:
+    """True if user_uid uploaded the replay or owns the session it belongs to."""
+    owner = await replay_storage.owner(f"{safe_session_id}.webm")
+    if owner is not None:
+        return owner == user_uid
+    return await run_in_threadpool(session_belongs_to, safe_session_id, user_uid)
+
+def is_not_modified(request_headers, response_headers) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2).
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or response_headers["etag"] in tags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(response_headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@app.get("/replays/{filename}/link")
+async def get_replay_link(filename: str, user_uid: str = Depends(get_current_user_uid)):
+    session_id = filename.removesuffix(".webm")
+    if session_id == filename or safe_replay_id(session_id) != session_id or not await replay_visible_to(session_id, user_uid):
+        raise HTTPException(status_code=404, detail="Replay not found")
+    expires = int(time.time()) + REPLAY_LINK_TTL_SECONDS
+    query = urlencode({"uid": user_uid, "expires": expires, "sig": sign_replay_link(filename, user_uid, expires)})
+    return {"url": f"/replays/{filename}?{query}", "expires": expires}
+
+@app.api_route("/replays/{filename}", methods=["GET", "HEAD"])
+async def serve_replay(filename: str, request: Request, user_uid: str = Depends(get_replay_viewer_uid)):
+    session_id = filename.removesuffix(".webm")
+    if session_id == filename or safe_replay_id(session_id) != session_id:
+        raise HTTPException(status_code=404, detail="Replay not found")
+    # Checked before fetching, so other users cannot pull replays from the store into the cache.
+    # Replays of other users' sessions look missing rather than forbidden.
+    if not await replay_visible_to(session_id, user_uid):
+        raise HTTPException(status_code=404, detail="Replay not found")
+    path = await replay_storage.fetch(filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Replay not found")
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Replay not found")
+
+    response = ReplayFileResponse(path, media_type="audio/webm", stat_result=stat_result,
+                                  headers={"Cache-Control": "private, no-cache"})
+    if is_not_modified(request.headers, response.headers):
+        return Response(status_code=304, headers={k: response.headers[k] for k in ("etag", "last-modified", "cache-control")})
+    # Range, If-Range and 206/416 are handled by FileResponse.
+    return response
+
+@app.get("/api/speech/cache-stats")
+async def get_transcript_cache_stats():
+    lookups = transcript_cache_stats["hits"] + transcript_cache_stats["misses"]
+    return {
+        **transcript_cache_stats,
+        "hit_rate": transcript_cache_stats["hits"] / lookups if lookups else 0.0,
+        "size": len(transcript_cache),
+        "max_size": transcript_cache.maxsize,
+    }
+
 
 # --- Endpoints Migrated for Pitch Deck Analyzer (Project 1) ---
 
@@ -703,43 +3280,88 @@ class ChatRequest(BaseModel):
     analysis: Dict[str, Any]
 
 @app.post("/api/analyze")
-async def analyze_pitch_deck_endpoint(pitchDeck: UploadFile = File(...)):
+async def analyze_pitch_deck_endpoint(pitchDeck: UploadFile = File(...), user_uid: Optional[str] = Depends(get_optional_user_uid)):
     if not pitchDeck or pitchDeck.filename == '':
         raise fastapi.HTTPException(status_code=400, detail="No selected file")
-    
+
+    if pitchDeck.size and pitchDeck.size > DECK_MAX_BYTES:
+        raise fastapi.HTTPException(status_code=413, detail=f"Pitch deck exceeds the {DECK_MAX_BYTES // (1024 * 1024)} MB limit.")
+    pdf_content = await pitchDeck.read()
+    if len(pdf_content) > DECK_MAX_BYTES:
+        raise fastapi.HTTPException(status_code=413, detail=f"Pitch deck exceeds the {DECK_MAX_BYTES // (1024 * 1024)} MB limit.")
+    # Re-uploads of the same deck are answered from the cache without taking a pool slot.
+    cache_key = DeckAnalysisCache.key(pdf_content, user_uid)
+    analysis_result = await deck_analysis_cache.get_or_compute(cache_key, lambda: analyze_uploaded_deck(pdf_content))
+    # The cached result keeps the text so its handle can always be re-registered; clients only get the ID.
+    deck_text = analysis_result.pop('deckText')
     try:
-        pdf_content = await pitchDeck.read()
-        pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
-        deck_text = "".join([page.get_text() for page in pdf_document])
-        pdf_document.close()
+        analysis_result['deckId'] = await deck_texts.put(deck_text)
+    except Exception as e:
+        # Without a durable copy the handle would break on another instance; fall back to the text.
+        print(f"Error storing deck text: {e}")
+        analysis_result['deckText'] = deck_text
+    return analysis_result
+
+async def analyze_uploaded_deck(pdf_content: bytes) -> dict:
+    deck_processing.admit()
+    try:
+        extracted = await deck_processing.extract_text(pdf_content)
+        deck_text, page_offsets = await deck_processing.run_parse(prepare_deck_text, extracted["pages"])
 
         if not deck_text.strip():
             raise fastapi.HTTPException(status_code=400, detail="Could not extract text from PDF.")
         
-        analysis_result = analyze_deck_with_gemini(deck_text)
+        analysis_result = await deck_processing.run_model(analyze_deck_with_gemini, deck_text)
         if "error" in analysis_result:
             raise fastapi.HTTPException(status_code=500, detail=analysis_result["error"])
 
-        initial_chat_message = generate_initial_chat_message(analysis_result)
+        initial_chat_message = await deck_processing.run_model(generate_initial_chat_message, analysis_result)
         analysis_result['initialChatMessage'] = initial_chat_message
         
         analysis_result['deckText'] = deck_text
+        analysis_result['deckPageOffsets'] = page_offsets
+        analysis_result['deckTruncated'] = extracted["truncated"]
         
         return analysis_result
 
+    except fastapi.HTTPException:
+        raise
     except Exception as e:
         print(f"An error occurred in the analysis endpoint: {e}")
         raise fastapi.HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+    finally:
+        deck_processing.release()
+
+@app.get("/api/deck/cache-stats")
+async def deck_cache_stats():
+    return {**deck_analysis_cache.stats, "memory_entries": len(deck_analysis_cache.memory)}
 
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatRequest):
+    deck_processing.admit_chat()
     try:
         history_dict = [msg.model_dump() for msg in request.history]
-        ai_response = chat_with_gemini(history_dict, request.topic, request.analysis)
+        ai_response = await deck_processing.run_model(chat_with_gemini, history_dict, request.topic, request.analysis)
         return {"reply": ai_response}
     except Exception as e:
         print(f"An error occurred in the chat endpoint: {e}")
         raise fastapi.HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+    finally:
+        deck_processing.release_chat()
+
+
+@app.get("/api/report-jobs/{job_id}")
+async def get_report_job(job_id: str, user_uid: str = Depends(get_current_user_uid)):
+    job = await report_jobs.get(job_id)
+    if not job or job.get("user_uid") != user_uid:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "error": job["error"] if job["status"] == "failed" else None,
+        "result": job["result"],
+    }
 
 
 # --- NEW: Endpoints for Startup Profile Management ---
@@ -748,13 +3370,15 @@ class StartupProfileCreate(BaseModel):
     name: str = Field(..., min_length=1)
     pitch: str = Field(..., min_length=1)
     problem: str = Field(..., min_length=1)
-    deckText: Optional[str] = None
+    deckId: Optional[str] = None
+    deckText: Optional[str] = None  # Legacy; stored as a deckId on save.
 
 class StartupProfileUpdate(BaseModel):
     name: Optional[str] = None
     pitch: Optional[str] = None
     problem: Optional[str] = None
-    deckText: Optional[str] = None
+    deckId: Optional[str] = None
+    deckText: Optional[str] = None  # Legacy; stored as a deckId on save.
 
 class StartupProfile(StartupProfileCreate):
     id: str
@@ -781,7 +3405,8 @@ async def create_user_profile(profile: StartupProfileCreate, user_uid: str = Dep
     if not fb_db: raise HTTPException(status_code=503, detail="Firestore not available")
     try:
         profiles_ref = fb_db.collection('users').document(user_uid).collection('profiles')
-        profile_data = profile.model_dump()
+        profile_data = profile.model_dump(exclude_none=True)
+        await resolve_deck_text(profile_data)
         profile_data['lastUsed'] = firestore.SERVER_TIMESTAMP
         update_time, doc_ref = profiles_ref.add(profile_data)
         
@@ -800,6 +3425,10 @@ async def update_user_profile(profile_id: str, profile_update: StartupProfileUpd
         update_data = profile_update.model_dump(exclude_unset=True)
         if not update_data:
             raise HTTPException(status_code=400, detail="No update data provided")
+        if update_data.get("deckText"):
+            await resolve_deck_text(update_data)
+            if "deckText" not in update_data:
+                update_data['deckText'] = firestore.DELETE_FIELD  # Only once the deckId copy is stored.
         
         update_data['lastUsed'] = firestore.SERVER_TIMESTAMP
         await run_in_threadpool(profile_ref.update, update_data)
@@ -842,12 +3471,15 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
     await manager.connect(websocket, user_uid)
     conn_data = manager.get_connection_data(websocket)
 
-    if not all([speech_client_v2, PROJECT_ID, GEMINI_API_KEY, moderation_model, pitch_eval_model, analysis_model]):
+    if not all([speech_backend.available(), GEMINI_API_KEY, moderation_model, pitch_eval_model, analysis_model]):
         await websocket.send_json({"type": "error", "text": "Server setup incomplete. A required model or client is missing."}); await websocket.close(code=1011); return
     if not conn_data or not conn_data.get("investor_chats") or not any(conn_data.get("investor_chats")):
         await websocket.send_json({"type": "error", "text": "Server error: Investor personas not initialized correctly."}); await websocket.close(code=1011); return
 
-    recognizer_path = f"projects/{PROJECT_ID}/locations/us-central1/recognizers/_"
+    transcription_pipeline = TranscriptionPipeline(websocket)
+
+    async def send_job_frame(frame):
+        await websocket.send_json(frame)
 
     try:
         while True:
@@ -860,8 +3492,10 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
                 if msg_type == "startup_details":
                     manager.reset_session_state(websocket)
                     conn_data['startup_details'] = message.get("data")
-                    conn_data['deck_context'] = message.get("data", {}).get("deckText")
+                    deck_text = await resolve_deck_text(conn_data['startup_details'] or {})
+                    conn_data['deck_context'] = await run_in_threadpool(fit_deck_text, deck_text, DECK_CONTEXT_TOKEN_BUDGET) if deck_text else None
                     conn_data['mode'] = message.get("data", {}).get("mode", "strict")
+                    conn_data['stream_replies'] = bool(message.get("data", {}).get("stream", STREAM_INVESTOR_REPLIES))
 
                     if conn_data['mode'] == 'drill':
                         investor_name = manager.get_next_investor_fallback(websocket) 
@@ -878,61 +3512,16 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
                         prompt_parts.append("Based on the context, ask your first, single, incisive question to the founder. Do not add pleasantries. Just ask the question.")
                         final_prompt = "\n".join(prompt_parts)
                         
-                        response = await run_in_threadpool(chat_session.send_message, final_prompt)
-                        conn_data['last_investor_name'] = investor_name 
-                        
-                        conn_data['conversation_history'].append({'role': investor_name, 'content': response.text.strip()})
-                        
-                        await websocket.send_json({"type": "investor", "investor_name": investor_name, "text": response.text.strip()})
+                        draft = InvestorReplyDraft(chat_session, final_prompt, stream=conn_data['stream_replies'])
+                        await deliver_investor_reply(websocket, conn_data, investor_name, draft)
 
                 elif msg_type == "send_composed_text":
                     composed_text = message.get("text", "").strip()
                     if not composed_text:
                         composed_text = "[Silent Response]"
                     
-                    conn_data['conversation_history'].append({'role': 'You', 'content': composed_text})
-
-                    is_safe, reason = await check_for_inappropriate_content(composed_text, moderation_model)
-                    if not is_safe:
-                        await websocket.send_json({"type": "session_terminated", "text": "This is a waste of time. The meeting is over.", "reason": reason})
-                        continue
-
-                    if conn_data['mode'] == 'strict' and not conn_data.get('opening_evaluated'):
-                        conn_data['opening_evaluated'] = True
-                        decision, reason = await evaluate_pitch_opening(composed_text, pitch_eval_model)
-                        if decision == 'TERMINATE':
-                            final_text_to_send = "I don't understand what you do. If you can't explain it clearly, there's no point in continuing. Meeting's over."
-                            conn_data['conversation_history'].append({'role': 'Alex Chen', 'content': f"[TERMINATE_SESSION] {final_text_to_send}"})
-                            await websocket.send_json({"type": "session_terminated", "reason": final_text_to_send})
-                            continue
-                    
-                    investor_name = await choose_next_speaker(conn_data['conversation_history'], manager.investor_names)
-                    if not investor_name:
-                        investor_name = manager.get_next_investor_fallback(websocket)
-
-                    if not investor_name or not conn_data["investor_chats"].get(investor_name):
-                        await websocket.send_json({"type": "error", "text": "No available investors to respond."}); continue
-
-                    chat_session = conn_data["investor_chats"][investor_name]
-                    
-                    prompt_to_investor = [composed_text]
-                    if not conn_data['initial_context_sent'] and conn_data['deck_context']:
-                        prompt_to_investor.insert(0, f"CONTEXT FROM PITCH DECK:\n---\n{conn_data['deck_context']}\n---\nFOUNDER'S RESPONSE:")
-                        conn_data['initial_context_sent'] = True
-                    
-                    investor_response = await run_in_threadpool(chat_session.send_message, "\n".join(prompt_to_investor))
-                    raw_response_text = investor_response.text.strip()
-                    
-                    conn_data['conversation_history'].append({'role': investor_name, 'content': raw_response_text})
-                    conn_data['last_investor_name'] = investor_name
-
-                    if raw_response_text.startswith("[TERMINATE_SESSION]"):
-                        final_text_to_send = raw_response_text.replace("[TERMINATE_SESSION]", "").strip()
-                        await websocket.send_json({"type": "investor", "investor_name": investor_name, "text": final_text_to_send})
-                        await websocket.send_json({"type": "session_terminated", "reason": final_text_to_send})
-                        continue
-                        
-                    await websocket.send_json({"type": "investor", "investor_name": investor_name, "text": raw_response_text})
+                    conn_data['transcript'].append('You', composed_text)
+                    await run_founder_turn(websocket, conn_data, composed_text)
 
                 elif msg_type == "end_session":
                     session_user_uid = conn_data.get("user_uid")
@@ -957,17 +3546,37 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
                         "end_reason": end_reason
                     }
 
-                    if current_mode == "strict":
-                        analyzer = PitchAnalyzer(history_for_analysis)
-                        analysis_report = await analyzer.analyze_pitch()
-                        report_data_to_save["analysis_report"] = analysis_report
-                    else:
-                        report_data_to_save["analysis_report"] = {"message": f"{current_mode.capitalize()} session completed."}
-                    
-                    await websocket.send_json({"type": "analysis_report", "data": report_data_to_save})
-                    
-                    if session_user_uid and fb_db:
-                        save_session_to_firestore(session_user_uid, client_session_id, report_data_to_save)
+                    job_id = await report_jobs.submit(session_user_uid, client_session_id, history_for_analysis, report_data_to_save, listener=send_job_frame)
+                    conn_data["report_job_ids"].append(job_id)
+                    await websocket.send_json({"type": "analysis_job", "job_id": job_id, "status": "queued"})
+
+                elif msg_type == "get_report_job":
+                    # Lets a reconnecting client pick up a report that was generated without it.
+                    job_id = str(message.get("job_id", ""))
+                    job = await report_jobs.get(job_id)
+                    if not job or job.get("user_uid") != conn_data.get("user_uid"):
+                        await websocket.send_json({"type": "error", "text": "Report job not found."}); continue
+                    await websocket.send_json({"type": "analysis_job", "job_id": job_id, "status": job["status"]})
+                    if job["status"] == "done":
+                        await websocket.send_json({"type": "analysis_report", "job_id": job_id, "data": job["result"]})
+                    elif job["status"] != "failed":
+                        report_jobs.subscribe(job_id, send_job_frame)
+                        conn_data["report_job_ids"].append(job_id)
+
+                elif msg_type == "audio_stream_start":
+                    # Live mode: the following binary frames are one utterance, streamed as recorded.
+                    if not speech_backend.supports_streaming:
+                        await websocket.send_json({"type": "error", "text": "Live transcription is not available on this server. Send complete utterances instead."}); continue
+                    if conn_data.get("speech_stream"):
+                        conn_data.pop("speech_stream").close()  # Its final transcript is sent when ready.
+                    if StreamingTranscriber.at_capacity():
+                        await websocket.send_json({"type": "error", "text": "Live transcription is busy right now. Send complete utterances instead."}); continue
+                    conn_data["speech_stream"] = StreamingTranscriber(websocket, speech_backend.recognizer_path, speech_backend.get_streaming_client())
+
+                elif msg_type == "audio_stream_end":
+                    speech_stream = conn_data.pop("speech_stream", None)
+                    if speech_stream:
+                        speech_stream.close()
 
                 elif msg_type == "get_history":
                     history_user_uid = conn_data.get("user_uid")
@@ -980,30 +3589,16 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
                 audio_bytes = data['bytes']
                 if not audio_bytes: continue
                 
-                transcribed_text = "[Could not understand audio]"
-                decoding_config = cloud_speech.ExplicitDecodingConfig(encoding=cloud_speech.ExplicitDecodingConfig.AudioEncoding.WEBM_OPUS, sample_rate_hertz=48000, audio_channel_count=1)
-                features_config = cloud_speech.RecognitionFeatures(enable_automatic_punctuation=True)
-                request_config = cloud_speech.RecognitionConfig(explicit_decoding_config=decoding_config, language_codes=["en-US"], model="chirp", features=features_config)
-                request_v2 = cloud_speech.RecognizeRequest(recognizer=recognizer_path, config=request_config, content=audio_bytes)
-                
-                try:
-                    response_v2 = await asyncio.wait_for(
-                        run_in_threadpool(speech_client_v2.recognize, request=request_v2),
-                        timeout=15.0
-                    )
-                    if response_v2.results and response_v2.results[0].alternatives:
-                        transcribed_text = response_v2.results[0].alternatives[0].transcript.strip()
-                        if not transcribed_text:
-                            transcribed_text = "[No speech detected]"
-                
-                except asyncio.TimeoutError:
-                    print("ERROR: Google Cloud Speech-to-Text API call timed out.")
-                    transcribed_text = "[Transcription timed out due to a network issue on the server.]"
-                except Exception as e:
-                    print(f"ERROR: Google Cloud Speech-to-Text API failed! Details: {e}")
-                    transcribed_text = "[Transcription failed on server. Please try again.]"
-                
-                await websocket.send_json({"type": "user_interim_transcript", "text": transcribed_text})
+                speech_stream = conn_data.get("speech_stream")
+                if speech_stream and (not speech_stream.closed or not audio_bytes.startswith(WEBM_MAGIC)):
+                    speech_stream.feed(audio_bytes)  # Discarded if the service already ended the stream.
+                    continue
+                if speech_stream:
+                    # A complete recording after the service ended the stream: the client has left
+                    # live mode without audio_stream_end, so go back to batch transcription.
+                    conn_data.pop("speech_stream").close()
+
+                await transcription_pipeline.submit(audio_bytes)
 
     except (WebSocketDisconnect, RuntimeError) as e:
         if isinstance(e, WebSocketDisconnect):
@@ -1013,6 +3608,11 @@ async def websocket_endpoint(websocket: WebSocket, token: str = None):
     except Exception as e:
         print(f"An unexpected error occurred in WebSocket: {e}"); traceback.print_exc()
     finally:
+        transcription_pipeline.close()
+        if conn_data.get("speech_stream"):
+            conn_data["speech_stream"].close()
+        for job_id in conn_data.get("report_job_ids", []):
+            report_jobs.unsubscribe(job_id, send_job_frame)
         manager.disconnect(websocket)
         print("INFO:     connection closed")
 